@@ -0,0 +1,257 @@
+"""Measure API throughput and latency against PostgreSQL.
+
+Generate data with ``benchmarks.data`` first, then either run the app
+in-process (client and server share one event loop) or point the
+harness at a running server::
+
+    python -m benchmarks.api --requests 2000 --concurrency 32
+    python -m benchmarks.api --url http://localhost:8000 \\
+        --compare benchmarks/results/<previous>.json
+
+Each run is saved as JSON (commit, settings, per-scenario throughput and
+p50/p95/p99 latency) in ``benchmarks/results/``, which git ignores, so
+results can be compared across commits.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import subprocess
+import uuid
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from sqlalchemy import func, select, text
+
+from benchmarks.data import NUMBER_OFFSET, TAG
+from src.database import SessionLocal, engine
+from src.models import Batch
+
+RESULTS = Path(__file__).parent / 'results'
+
+Request = Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+
+class Dataset:
+    """Keys of the generated data the scenarios draw their requests from."""
+
+    def __init__(self, batches, codes, next_number):
+        self.batches = batches
+        self.dates = sorted({batch_date for _, batch_date, _ in batches})
+        self.codes = codes
+        self.next_number = next_number
+
+    @classmethod
+    async def load(cls, aggregations: int) -> 'Dataset':
+        async with SessionLocal() as db:
+            batches = (await db.execute(
+                select(Batch.id, Batch.date, Batch.number)
+                .where(Batch.assignment == TAG)
+            )).all()
+            codes = (await db.execute(text("""
+                SELECT code, batch_id FROM product
+                WHERE NOT is_aggregated AND code LIKE 'bench-%'
+                LIMIT :limit
+            """), {'limit': aggregations})).all()
+            next_number = await db.scalar(
+                select(func.max(Batch.number)).where(Batch.assignment == TAG)
+            )
+        if not batches:
+            raise SystemExit('no benchmark data, run benchmarks.data first')
+        return cls(batches, codes, (next_number or NUMBER_OFFSET) + 1)
+
+
+def batch_payload(number: int) -> dict:
+    now = datetime.now()
+    batch_date = date(2100, 1, 1) + timedelta(number % 3650)
+    return {
+        "СтатусЗакрытия": False,
+        "ПредставлениеЗаданияНаСмену": TAG,
+        "Линия": "Линия 1",
+        "Смена": "1",
+        "Бригада": "Бригада 1",
+        "НомерПартии": number,
+        "ДатаПартии": batch_date.isoformat(),
+        "Номенклатура": "Номенклатура 1",
+        "КодЕКН": "1",
+        "ИдентификаторРЦ": "РЦ 1",
+        "ДатаВремяНачалаСмены": (now - timedelta(hours=12)).isoformat(),
+        "ДатаВремяОкончанияСмены": now.isoformat(),
+    }
+
+
+def scenarios(data: Dataset, batch_size: int) -> Dict[str, Request]:
+    async def create_batch(client, index):
+        first = data.next_number + index * batch_size
+        return await client.post('/batches/', json=[
+            batch_payload(number)
+            for number in range(first, first + batch_size)
+        ])
+
+    async def create_product(client, index):
+        _, batch_date, number = random.choice(data.batches)
+        return await client.post('/products/', json=[
+            {
+                "УникальныйКодПродукта": f'bench-{uuid.uuid4().hex}',
+                "НомерПартии": number,
+                "ДатаПартии": batch_date.isoformat(),
+            }
+            for _ in range(batch_size)
+        ])
+
+    async def aggregate_product(client, index):
+        code, batch_id = data.codes[index % len(data.codes)]
+        return await client.patch(
+            '/products/', json={'id': batch_id, 'code': code}
+        )
+
+    async def get_batches(client, index):
+        batch_date = random.choice(data.dates).isoformat()
+        return await client.get(f'/batches/?date={batch_date}&limit=100')
+
+    async def get_batches_products(client, index):
+        batch_date = random.choice(data.dates).isoformat()
+        return await client.get(
+            f'/batches/?date={batch_date}&limit=100&include=products'
+        )
+
+    return {
+        'create_batch': create_batch,
+        'create_product': create_product,
+        'aggregate_product': aggregate_product,
+        'get_batches': get_batches,
+        'get_batches_products': get_batches_products,
+    }
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'per_second': len(latencies) / elapsed,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+    }
+
+
+async def run(
+    client: httpx.AsyncClient,
+    request: Request,
+    requests: int,
+    concurrency: int
+) -> dict:
+    indexes = iter(range(requests))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for index in indexes:
+            started = perf_counter()
+            response = await request(client, index)
+            latencies.append(perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, perf_counter() - started)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict) -> None:
+    for name, stats in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = '  '.join(
+            f"{key} {(stats[key] / before[key] - 1) * 100:+6.1f}%"
+            for key in ('per_second', 'p50_ms', 'p99_ms')
+            if before[key]
+        )
+        print(f"{name:>22}: {changes}")
+
+
+async def main(arguments: argparse.Namespace) -> None:
+    try:
+        data = await Dataset.load(arguments.requests)
+        if arguments.url:
+            transport = None
+            base_url = arguments.url
+        else:
+            from src.main import app
+            transport = httpx.ASGITransport(app=app)
+            base_url = 'http://benchmark'
+        selected = scenarios(data, arguments.batch_size)
+        results = {
+            'commit': git_commit(),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'database': engine.url.render_as_string(hide_password=True),
+            'target': arguments.url or 'in-process',
+            'requests': arguments.requests,
+            'concurrency': arguments.concurrency,
+            'batch_size': arguments.batch_size,
+            'batches': len(data.batches),
+            'scenarios': {},
+        }
+        async with httpx.AsyncClient(
+            transport=transport, base_url=base_url, timeout=60
+        ) as client:
+            for name in arguments.scenario or selected:
+                stats = await run(
+                    client, selected[name],
+                    arguments.requests, arguments.concurrency,
+                )
+                results['scenarios'][name] = stats
+                print(
+                    f"{name:>22}: {stats['per_second']:8.0f} req/s  "
+                    f"p50 {stats['p50_ms']:7.2f} ms  "
+                    f"p95 {stats['p95_ms']:7.2f} ms  "
+                    f"p99 {stats['p99_ms']:7.2f} ms  "
+                    f"errors {stats['errors']}"
+                )
+    finally:
+        await engine.dispose()
+    output = arguments.output or RESULTS / (
+        f"{results['created_at'].replace(':', '')}"
+        f"-{results['commit'] or 'unknown'}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f'saved {output}')
+    if arguments.compare:
+        compare(results, json.loads(arguments.compare.read_text()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='running server, default in-process')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument(
+        '--batch-size', type=int, default=10,
+        help='batches or products sent per create request',
+    )
+    parser.add_argument(
+        '--scenario', action='append',
+        choices=['create_batch', 'create_product', 'aggregate_product',
+                 'get_batches', 'get_batches_products'],
+    )
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--compare', type=Path)
+    asyncio.run(main(parser.parse_args()))
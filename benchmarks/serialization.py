@@ -0,0 +1,93 @@
+"""Compare response serialization paths on a page of batches.
+
+No database is needed: the page is built from transient ORM objects and
+served by a throwaway app, so only FastAPI and pydantic work is timed::
+
+    python -m benchmarks.serialization --batches 1000 --products 10
+"""
+import argparse
+import statistics
+from datetime import date, datetime, timedelta
+from time import perf_counter
+from typing import List
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.testclient import TestClient
+
+from src.models import Batch, Product
+from src.schemas import BatchRead
+from src.serialization import BATCH_LIST, json_response
+
+
+def make_page(batches: int, products: int) -> List[Batch]:
+    now = datetime(2024, 2, 10, 8)
+    page = []
+    for number in range(batches):
+        batch = Batch(
+            id=number + 1, status=False, assignment='benchmark',
+            line='benchmark', shift='1', squad='1', number=number,
+            date=date(2024, 1, 1) + timedelta(days=number % 365),
+            nomenclature='benchmark', codekn='0', identificator_rc='0',
+            start_time=now, end_time=now, closed_at=None,
+            product_count=products, aggregated_count=products // 2,
+            last_aggregated_at=now,
+        )
+        batch.products = [
+            Product(
+                id=number * products + index + 1,
+                code=f'{number}-{index}', batch_number=number,
+                date=batch.date, is_aggregated=index % 2 == 0,
+                aggregated_at=now if index % 2 == 0 else None,
+                batch_id=batch.id,
+            )
+            for index in range(products)
+        ]
+        page.append(batch)
+    return page
+
+
+def make_app(page: List[Batch]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/json', response_model=List[BatchRead],
+             response_class=JSONResponse)
+    def stdlib_json():
+        return [BatchRead.model_validate(batch) for batch in page]
+
+    @app.get('/orjson', response_model=List[BatchRead],
+             response_class=ORJSONResponse)
+    def orjson():
+        return [BatchRead.model_validate(batch) for batch in page]
+
+    @app.get('/adapter', response_model=List[BatchRead])
+    def adapter():
+        return json_response(BATCH_LIST, page)
+
+    return app
+
+
+def main(batches: int, products: int, repeat: int) -> None:
+    client = TestClient(make_app(make_page(batches, products)))
+    bodies = []
+    for path in ('/json', '/orjson', '/adapter'):
+        bodies.append(client.get(path).json())
+        timings = []
+        for _ in range(repeat):
+            started = perf_counter()
+            client.get(path)
+            timings.append(perf_counter() - started)
+        print(
+            f"{path:>10}: median {statistics.median(timings) * 1000:7.1f} ms"
+            f"  min {min(timings) * 1000:7.1f} ms"
+        )
+    assert all(body == bodies[0] for body in bodies), 'paths disagree'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batches', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    arguments = parser.parse_args()
+    main(arguments.batches, arguments.products, arguments.repeat)
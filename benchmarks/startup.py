@@ -0,0 +1,93 @@
+"""Measure how long a new worker takes until it serves its first request.
+
+Every sample is a fresh interpreter that imports ``src.main``, builds the
+app with ``create_app()``, runs its lifespan startup against
+``DATABASE_URL`` and sends the first two requests in-process, the way a
+uvicorn worker would receive them::
+
+    python -m benchmarks.startup --runs 10
+
+Samples run with ``APP_WARMUP`` off and on, so the cost moved from the
+first requests into startup is visible.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+PHASES = (
+    'ready', 'import', 'create_app', 'lifespan',
+    'first openapi', 'first batches', 'second batches',
+)
+
+
+async def child(spawned_at: float) -> Dict[str, float]:
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(name: str) -> None:
+        nonlocal started
+        now = time.perf_counter()
+        timings[name] = (now - started) * 1000
+        started = now
+
+    import httpx
+
+    from src.main import create_app
+    lap('import')
+    app = create_app()
+    lap('create_app')
+    async with app.router.lifespan_context(app):
+        lap('lifespan')
+        timings['ready'] = (time.time() - spawned_at) * 1000
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url='http://startup'
+        ) as client:
+            started = time.perf_counter()
+            (await client.get('/openapi.json')).raise_for_status()
+            lap('first openapi')
+            (await client.get('/batches/')).raise_for_status()
+            lap('first batches')
+            (await client.get('/batches/')).raise_for_status()
+            lap('second batches')
+    return timings
+
+
+def sample(warmup: bool) -> Dict[str, float]:
+    environment = dict(os.environ, APP_WARMUP=str(warmup).lower())
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.startup',
+         '--child', str(time.time())],
+        env=environment, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(samples: int) -> None:
+    print(f"{'median, ms':<16}{'no warmup':>12}{'warmup':>12}")
+    results: Dict[bool, List[Dict[str, float]]] = {}
+    for warmup in (False, True):
+        results[warmup] = [sample(warmup) for _ in range(samples)]
+    for phase in PHASES:
+        cells = ''.join(
+            f'{statistics.median(run[phase] for run in runs):>12.1f}'
+            for runs in results.values()
+        )
+        print(f'{phase:<16}{cells}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    if arguments.child is not None:
+        print(json.dumps(asyncio.run(child(arguments.child))))
+    else:
+        main(arguments.runs)
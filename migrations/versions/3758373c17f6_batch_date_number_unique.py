@@ -0,0 +1,45 @@
+"""batch (date, number) unique constraint
+
+Revision ID: 3758373c17f6
+Revises: 330692f34a2a
+Create Date: 2026-10-18 15:50:12.104913
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3758373c17f6'
+down_revision: Union[str, None] = '330692f34a2a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+DUPLICATES = """
+    SELECT id, max(id) OVER (PARTITION BY date, number) AS keep_id
+    FROM batch
+"""
+
+
+def upgrade() -> None:
+    # Earlier imports replaced batches by (date, number), so the newest row
+    # of every duplicate group wins and inherits the older rows' products.
+    op.execute(sa.text(f"""
+        UPDATE product SET batch_id = duplicates.keep_id
+        FROM ({DUPLICATES}) AS duplicates
+        WHERE product.batch_id = duplicates.id
+          AND duplicates.id <> duplicates.keep_id
+    """))
+    op.execute(sa.text(f"""
+        DELETE FROM batch USING ({DUPLICATES}) AS duplicates
+        WHERE batch.id = duplicates.id
+          AND duplicates.id <> duplicates.keep_id
+    """))
+    op.create_unique_constraint(
+        'uq_batch_date_number', 'batch', ['date', 'number']
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_batch_date_number', 'batch', type_='unique')
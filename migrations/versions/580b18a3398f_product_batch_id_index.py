@@ -0,0 +1,46 @@
+"""product batch_id indexes
+
+Revision ID: 580b18a3398f
+Revises: d1252862383c
+Create Date: 2026-10-18 16:21:07.830142
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '580b18a3398f'
+down_revision: Union[str, None] = 'd1252862383c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f('ix_product_batch_id'), 'product', ['batch_id'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            'ix_product_batch_id_aggregated', 'product', ['batch_id'],
+            postgresql_where=sa.text('is_aggregated'),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_product_batch_id_aggregated', table_name='product',
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            op.f('ix_product_batch_id'), table_name='product',
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
@@ -0,0 +1,50 @@
+"""batch product counters
+
+Revision ID: 9c41e7d2b5a8
+Revises: 580b18a3398f
+Create Date: 2026-10-18 17:05:12.418305
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '9c41e7d2b5a8'
+down_revision: Union[str, None] = '580b18a3398f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('batch', sa.Column(
+        'product_count', sa.Integer(), server_default='0', nullable=False
+    ))
+    op.add_column('batch', sa.Column(
+        'aggregated_count', sa.Integer(), server_default='0', nullable=False
+    ))
+    op.add_column('batch', sa.Column(
+        'last_aggregated_at', sa.DateTime(), nullable=True
+    ))
+    op.execute("""
+        UPDATE batch
+        SET product_count = counts.total,
+            aggregated_count = counts.aggregated,
+            last_aggregated_at = counts.last_aggregated_at
+        FROM (
+            SELECT batch_id,
+                   count(*) AS total,
+                   count(*) FILTER (WHERE is_aggregated) AS aggregated,
+                   max(aggregated_at) AS last_aggregated_at
+            FROM product
+            GROUP BY batch_id
+        ) AS counts
+        WHERE counts.batch_id = batch.id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('batch', 'last_aggregated_at')
+    op.drop_column('batch', 'aggregated_count')
+    op.drop_column('batch', 'product_count')
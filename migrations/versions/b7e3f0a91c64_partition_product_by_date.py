@@ -0,0 +1,119 @@
+"""partition product by date
+
+Revision ID: b7e3f0a91c64
+Revises: 9c41e7d2b5a8
+Create Date: 2026-10-18 19:42:37.105829
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e3f0a91c64'
+down_revision: Union[str, None] = '9c41e7d2b5a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Partitions are created from the oldest product up to this many months
+# ahead; the workers create later ones, see src.partitions.keep_partitions.
+MONTHS_AHEAD = 12
+
+COLUMNS = 'id, code, batch_number, date, is_aggregated, aggregated_at, ' \
+          'batch_id'
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def create_indexes(unique_code: bool) -> None:
+    op.create_index(
+        op.f('ix_product_code'), 'product', ['code'], unique=unique_code
+    )
+    op.create_index(op.f('ix_product_batch_id'), 'product', ['batch_id'])
+    op.create_index(
+        'ix_product_batch_id_aggregated', 'product', ['batch_id'],
+        postgresql_where=sa.text('is_aggregated'),
+    )
+    op.create_foreign_key(
+        'product_batch_id_fkey', 'product', 'batch', ['batch_id'], ['id']
+    )
+
+
+def upgrade() -> None:
+    op.create_table(
+        'product_code',
+        sa.Column('code', sa.String(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.PrimaryKeyConstraint('code'),
+    )
+    op.execute("INSERT INTO product_code (code, date) "
+               "SELECT code, date FROM product")
+
+    # The new table takes the id sequence over, so it must outlive the old.
+    op.execute("ALTER SEQUENCE product_id_seq OWNED BY NONE")
+    op.execute("""
+        CREATE TABLE product_partitioned (
+            id integer NOT NULL DEFAULT nextval('product_id_seq'),
+            code varchar NOT NULL,
+            batch_number integer NOT NULL,
+            date date NOT NULL,
+            is_aggregated boolean,
+            aggregated_at timestamp without time zone,
+            batch_id integer
+        ) PARTITION BY RANGE (date)
+    """)
+    oldest = op.get_bind().execute(sa.text(
+        "SELECT min(date) FROM product"
+    )).scalar()
+    month = date.today().replace(day=1)
+    last = add_months(month, MONTHS_AHEAD)
+    if oldest is not None:
+        month = min(month, oldest.replace(day=1))
+    while month <= last:
+        op.execute(
+            f"CREATE TABLE product_{month.year:04d}_{month.month:02d} "
+            f"PARTITION OF product_partitioned "
+            f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+        )
+        month = add_months(month, 1)
+    op.execute("CREATE TABLE product_default "
+               "PARTITION OF product_partitioned DEFAULT")
+    op.execute(f"INSERT INTO product_partitioned ({COLUMNS}) "
+               f"SELECT {COLUMNS} FROM product")
+    op.drop_table('product')
+    op.rename_table('product_partitioned', 'product')
+    op.execute("ALTER SEQUENCE product_id_seq OWNED BY product.id")
+
+    op.create_primary_key('product_pkey', 'product', ['id', 'date'])
+    create_indexes(unique_code=False)
+    op.execute("ANALYZE product")
+
+
+def downgrade() -> None:
+    op.execute("ALTER SEQUENCE product_id_seq OWNED BY NONE")
+    op.execute("""
+        CREATE TABLE product_plain (
+            id integer NOT NULL DEFAULT nextval('product_id_seq'),
+            code varchar NOT NULL,
+            batch_number integer NOT NULL,
+            date date NOT NULL,
+            is_aggregated boolean,
+            aggregated_at timestamp without time zone,
+            batch_id integer
+        )
+    """)
+    op.execute(f"INSERT INTO product_plain ({COLUMNS}) "
+               f"SELECT {COLUMNS} FROM product")
+    # Drops every partition, detached ones are left alone.
+    op.drop_table('product')
+    op.rename_table('product_plain', 'product')
+    op.execute("ALTER SEQUENCE product_id_seq OWNED BY product.id")
+
+    op.create_primary_key('product_pkey', 'product', ['id'])
+    create_indexes(unique_code=True)
+    op.drop_table('product_code')
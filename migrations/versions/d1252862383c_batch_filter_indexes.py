@@ -0,0 +1,67 @@
+"""batch keyset and filter indexes
+
+Revision ID: d1252862383c
+Revises: 3758373c17f6
+Create Date: 2026-10-18 16:02:41.559310
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'd1252862383c'
+down_revision: Union[str, None] = '3758373c17f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = {
+    'ix_batch_date_id': ['date', 'id'],
+    'ix_batch_status_date_id': ['status', 'date', 'id'],
+    'ix_batch_line_shift_date_id': ['line', 'shift', 'date', 'id'],
+    'ix_batch_number_date_id': ['number', 'date', 'id'],
+}
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Build the indexes without blocking writes to a live batch table.
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES.items():
+            op.create_index(
+                name, 'batch', columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+        op.create_index(
+            'ix_batch_assignment_trgm', 'batch', ['assignment'],
+            postgresql_using='gin',
+            postgresql_ops={'assignment': 'gin_trgm_ops'},
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.drop_index(
+            'ix_batch_codekn', table_name='batch',
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_batch_codekn', 'batch', ['codekn'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.drop_index(
+            'ix_batch_assignment_trgm', table_name='batch',
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        for name in reversed(list(INDEXES)):
+            op.drop_index(
+                name, table_name='batch',
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
@@ -0,0 +1,85 @@
+"""archive tables
+
+Revision ID: e26820ae2833
+Revises: e5a2c8d14f37
+Create Date: 2026-10-18 22:14:08.316402
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e26820ae2833'
+down_revision: Union[str, None] = 'e5a2c8d14f37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'batch_archive',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.Boolean(), nullable=True),
+        sa.Column('assignment', sa.String(), nullable=False),
+        sa.Column('line', sa.String(), nullable=False),
+        sa.Column('shift', sa.String(), nullable=False),
+        sa.Column('squad', sa.String(), nullable=False),
+        sa.Column('number', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('nomenclature', sa.String(), nullable=False),
+        sa.Column('codekn', sa.String(), nullable=False),
+        sa.Column('identificator_rc', sa.String(), nullable=False),
+        sa.Column('start_time', sa.TIMESTAMP(), nullable=False),
+        sa.Column('end_time', sa.TIMESTAMP(), nullable=False),
+        sa.Column('closed_at', sa.TIMESTAMP(), nullable=True),
+        sa.Column('product_count', sa.Integer(), nullable=False),
+        sa.Column('aggregated_count', sa.Integer(), nullable=False),
+        sa.Column('last_aggregated_at', sa.DateTime(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'product_archive',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('code', sa.String(), nullable=False),
+        sa.Column('batch_number', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('is_aggregated', sa.Boolean(), nullable=True),
+        sa.Column('aggregated_at', sa.DateTime(), nullable=True),
+        sa.Column('batch_id', sa.Integer(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        op.f('ix_product_archive_code'), 'product_archive', ['code'],
+        unique=True,
+    )
+    op.create_index(
+        op.f('ix_product_archive_batch_id'), 'product_archive', ['batch_id'],
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_batch_closed_at', 'batch', ['closed_at'],
+            postgresql_where=sa.text('status'),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_batch_closed_at', table_name='batch',
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+    op.drop_index(
+        op.f('ix_product_archive_batch_id'), table_name='product_archive'
+    )
+    op.drop_index(
+        op.f('ix_product_archive_code'), table_name='product_archive'
+    )
+    op.drop_table('product_archive')
+    op.drop_table('batch_archive')
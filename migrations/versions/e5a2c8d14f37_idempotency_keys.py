@@ -0,0 +1,41 @@
+"""idempotency keys
+
+Revision ID: e5a2c8d14f37
+Revises: b7e3f0a91c64
+Create Date: 2026-10-18 20:31:54.602178
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a2c8d14f37'
+down_revision: Union[str, None] = 'b7e3f0a91c64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'idempotency_key',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('fingerprint', sa.String(), nullable=True),
+        sa.Column('status_code', sa.Integer(), nullable=True),
+        sa.Column('content_type', sa.String(), nullable=True),
+        sa.Column('body', sa.LargeBinary(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    op.create_index(
+        op.f('ix_idempotency_key_expires_at'), 'idempotency_key',
+        ['expires_at'],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f('ix_idempotency_key_expires_at'), table_name='idempotency_key'
+    )
+    op.drop_table('idempotency_key')
@@ -0,0 +1,52 @@
+"""Move long-closed batches and their products into archive tables.
+
+Codes stay registered in ``product_code``, so they are never issued
+twice. Like :mod:`src.crud`, nothing here commits.
+"""
+from datetime import datetime
+from typing import Tuple
+
+from sqlalchemy import delete, insert, literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Batch, BatchArchive, Product, ProductArchive
+
+
+def move(source, target, condition, archived_at: datetime):
+    columns = [column.name for column in source.columns]
+    return insert(target).from_select(
+        [*columns, 'archived_at'],
+        select(*source.columns, literal(archived_at)).where(condition),
+    )
+
+
+async def archive_batches(
+    db: AsyncSession,
+    closed_before: datetime,
+    limit: int
+) -> Tuple[int, int]:
+    """Move up to ``limit`` batches closed before ``closed_before``.
+
+    Returns the numbers of batches and products moved. Batches locked by
+    a running request are left for a later run.
+    """
+    keys = (await db.execute(
+        select(Batch.id, Batch.date)
+        .where(Batch.status.is_(True), Batch.closed_at < closed_before)
+        .order_by(Batch.closed_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )).tuples().all()
+    if not keys:
+        return 0, 0
+    now = datetime.now()
+    batches, products = Batch.__table__, Product.__table__
+    of_batches = tuple_(products.c.batch_id, products.c.date).in_(keys)
+    batch_ids = batches.c.id.in_([batch_id for batch_id, _ in keys])
+    await db.execute(
+        move(products, ProductArchive.__table__, of_batches, now)
+    )
+    moved = await db.execute(delete(products).where(of_batches))
+    await db.execute(move(batches, BatchArchive.__table__, batch_ids, now))
+    await db.execute(delete(batches).where(batch_ids))
+    return len(keys), moved.rowcount
@@ -0,0 +1,383 @@
+"""In-process Bloom filter of issued product codes.
+
+Scanners send plenty of garbage and foreign codes. With
+``CODE_FILTER_ENABLED`` every worker keeps a Bloom filter of the codes in
+``product_code`` and answers codes the filter has definitely not seen
+with "not found" without a query. A Bloom filter has false positives but
+no false negatives, so it has to learn every new code before anyone can
+scan it:
+
+* the worker that inserts codes adds them right away (see :func:`learn_codes`);
+* on PostgreSQL the inserting transaction also ``pg_notify``-s them, and
+  the other workers add them when the commit is delivered. Delivery lags
+  the commit, so before a listening worker rejects a code it makes sure
+  it has heard of every commit so far, see :meth:`CodeFilter.missing`;
+* the filter is rebuilt from a streamed scan at startup, every
+  ``CODE_FILTER_REBUILD_INTERVAL`` seconds and whenever the notification
+  connection was lost. Until the first build, and after a lost
+  connection, every code goes to the database.
+
+Codes written outside the API, such as generated benchmark data, are only
+picked up by the next rebuild.
+"""
+import asyncio
+import json
+import logging
+import math
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import event, select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
+
+from .metrics import REGISTRY
+from .models import ProductCode
+from .settings import (CODE_FILTER_CAPACITY, CODE_FILTER_ENABLED,
+                       CODE_FILTER_ERROR_RATE, CODE_FILTER_REBUILD_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'product_codes'
+# PostgreSQL rejects NOTIFY payloads from 8000 bytes on.
+MAX_PAYLOAD_BYTES = 7900
+SCAN_CHUNK_SIZE = 5000
+
+# Codes learned by transactions of this process that have not ended yet,
+# by id of their list, see learn_codes().
+UNCOMMITTED: Dict[int, List[str]] = {}
+
+CODE_FILTER_REJECTIONS = REGISTRY.counter(
+    'code_filter_rejections_total',
+    'Codes answered as unknown by the code filter, without a query.',
+)
+CODE_FILTER_FALSE_POSITIVES = REGISTRY.counter(
+    'code_filter_false_positives_total',
+    'Codes the code filter let through that the database did not know.',
+)
+CODE_FILTER_SYNCS = REGISTRY.counter(
+    'code_filter_syncs_total',
+    'Round trips on the notification connection to confirm rejections.',
+)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter of strings.
+
+    Sized for ``capacity`` items at ``error_rate`` false positives; past
+    ``capacity`` the rate grows, see :attr:`false_positive_rate`.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = max(bits, 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item: str) -> List[int]:
+        # Double hashing: k positions from two halves of one digest.
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [
+            (first + index * second) % self.size
+            for index in range(self.hashes)
+        ]
+
+    def add(self, item: str) -> None:
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] >> (position & 7) & 1
+            for position in self.positions(item)
+        )
+
+    @property
+    def false_positive_rate(self) -> float:
+        """Expected false positive rate for the items added so far."""
+        filled = 1 - math.exp(-self.hashes * self.count / self.size)
+        return filled ** self.hashes
+
+
+class CodeFilter:
+    """The process-wide filter of product codes and its maintenance."""
+
+    def __init__(
+        self,
+        capacity: int,
+        error_rate: float,
+        enabled: bool,
+        rebuild_interval: float
+    ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.enabled = enabled
+        self.rebuild_interval = rebuild_interval
+        self.filter: Optional[BloomFilter] = None
+        # The filter being built also learns codes inserted meanwhile.
+        self.building: Optional[BloomFilter] = None
+        # The LISTEN connection, the sync the next misses wait for and the
+        # task sending the round trips, one at a time.
+        self.connection = None
+        self.next_sync: Optional[asyncio.Future] = None
+        self.syncer: Optional[asyncio.Future] = None
+
+    async def missing(self, codes: Iterable[str]) -> Set[str]:
+        """The ``codes`` that are certainly not issued.
+
+        While other workers' codes arrive by notification, codes the
+        filter misses are only rejected after a round trip on the
+        notification connection: PostgreSQL delivers the notifications of
+        every transaction committed before it ahead of its result, so a
+        code a client was told about is learned by then. Concurrent misses
+        share one round trip. Without a current filter nothing is
+        rejected.
+        """
+        if self.filter is None:
+            return set()
+        missing = {code for code in codes if code not in self.filter}
+        if missing and self.connection is not None:
+            try:
+                await self.sync()
+            except Exception:
+                logger.warning('code filter sync failed', exc_info=True)
+                return set()
+            if self.filter is None:
+                return set()
+            missing = {code for code in missing if code not in self.filter}
+        if missing:
+            CODE_FILTER_REJECTIONS.inc(len(missing))
+        return missing
+
+    async def sync(self) -> None:
+        """Wait for a round trip on the notification connection.
+
+        Only a round trip sent after the call counts, so callers never
+        join one already on its way.
+        """
+        if self.next_sync is None:
+            self.next_sync = asyncio.get_running_loop().create_future()
+            if self.syncer is None:
+                self.syncer = asyncio.ensure_future(self.run_syncs())
+        await asyncio.shield(self.next_sync)
+
+    async def run_syncs(self) -> None:
+        """Send round trips until no caller waits for another."""
+        waiting = None
+        try:
+            while self.next_sync is not None:
+                waiting, self.next_sync = self.next_sync, None
+                try:
+                    if self.connection is None:
+                        raise ConnectionError(
+                            'code notifications not listened to'
+                        )
+                    CODE_FILTER_SYNCS.inc()
+                    await self.connection.fetchval('SELECT 1')
+                except Exception as error:
+                    waiting.set_exception(error)
+                    # Marked as retrieved, in case every waiter was cancelled.
+                    waiting.exception()
+                else:
+                    waiting.set_result(None)
+        finally:
+            self.syncer = None
+            for future in (waiting, self.next_sync):
+                if future is not None and not future.done():
+                    future.set_exception(
+                        ConnectionError('code filter sync cancelled')
+                    )
+                    future.exception()
+            self.next_sync = None
+
+    def missed(self, count: int) -> None:
+        """Record ``count`` codes let through but unknown to the database."""
+        if self.filter is not None and count:
+            CODE_FILTER_FALSE_POSITIVES.inc(count)
+
+    def learn(self, codes: Iterable[str]) -> None:
+        codes = list(codes)
+        for bloom in (self.filter, self.building):
+            if bloom is not None:
+                for code in codes:
+                    bloom.add(code)
+
+    def on_notify(self, connection, pid, channel, payload: str) -> None:
+        self.learn(json.loads(payload))
+
+    async def build(self, sessions: async_sessionmaker) -> None:
+        current = self.filter.count if self.filter is not None else 0
+        self.building = BloomFilter(
+            max(self.capacity, 2 * current), self.error_rate
+        )
+        # Learned before the new filter was, and may commit after the scan
+        # has started.
+        unsettled = list(UNCOMMITTED.values())
+        try:
+            async with sessions() as db:
+                codes = await db.stream_scalars(
+                    select(ProductCode.code)
+                    .execution_options(yield_per=SCAN_CHUNK_SIZE)
+                )
+                async for chunk in codes.partitions():
+                    for code in chunk:
+                        self.building.add(code)
+            for codes in unsettled:
+                for code in codes:
+                    self.building.add(code)
+            self.filter = self.building
+        finally:
+            self.building = None
+        logger.info(
+            'code filter built with %d codes, %.1f MB',
+            self.filter.count, len(self.filter.bits) / 2 ** 20,
+        )
+
+    async def run(self, sessions: async_sessionmaker) -> None:
+        """Build the filter and keep it complete until cancelled."""
+        engine = sessions.kw['bind']
+        while True:
+            try:
+                if engine.dialect.name == 'postgresql':
+                    await self.listen(sessions)
+                else:
+                    # No other processes to hear from, see learn_codes().
+                    await self.rebuild_forever(sessions)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('code filter failed, rebuilding')
+                await asyncio.sleep(1)
+
+    async def listen(self, sessions: async_sessionmaker) -> None:
+        """Rebuild periodically while learning the codes others insert.
+
+        Returns, by raising, only when the connection is lost.
+        """
+        async with sessions.kw['bind'].connect() as connection:
+            raw = (await connection.get_raw_connection()).driver_connection
+            lost = asyncio.get_running_loop().create_future()
+
+            def on_lost(connection) -> None:
+                if not lost.done():
+                    lost.set_exception(
+                        ConnectionError('code notifications connection lost')
+                    )
+
+            raw.add_termination_listener(on_lost)
+            await raw.add_listener(CHANNEL, self.on_notify)
+            rebuilds = asyncio.ensure_future(self.rebuild_forever(sessions))
+            self.connection = raw
+            try:
+                done, _ = await asyncio.wait(
+                    {lost, rebuilds}, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+            finally:
+                # Codes may be missed from now on, stop trusting the filter
+                # before anything else can run.
+                self.filter = None
+                self.connection = None
+                rebuilds.cancel()
+                raw.remove_termination_listener(on_lost)
+                if not raw.is_closed():
+                    await raw.remove_listener(CHANNEL, self.on_notify)
+
+    async def rebuild_forever(self, sessions: async_sessionmaker) -> None:
+        while True:
+            await self.build(sessions)
+            await asyncio.sleep(self.rebuild_interval)
+
+    def memory(self) -> int:
+        return sum(
+            len(bloom.bits) for bloom in (self.filter, self.building)
+            if bloom is not None
+        )
+
+    def false_positive_rate(self) -> float:
+        return -1 if self.filter is None else self.filter.false_positive_rate
+
+
+CODE_FILTER = CodeFilter(
+    CODE_FILTER_CAPACITY,
+    CODE_FILTER_ERROR_RATE,
+    CODE_FILTER_ENABLED,
+    CODE_FILTER_REBUILD_INTERVAL,
+)
+
+REGISTRY.gauge(
+    'code_filter_bytes',
+    'Memory held by the code filter, twice that while rebuilding.',
+    CODE_FILTER.memory,
+)
+REGISTRY.gauge(
+    'code_filter_codes',
+    'Codes in the code filter.',
+    lambda: 0 if CODE_FILTER.filter is None else CODE_FILTER.filter.count,
+)
+REGISTRY.gauge(
+    'code_filter_false_positive_rate',
+    'Expected false positive rate of the code filter, -1 while not built.',
+    CODE_FILTER.false_positive_rate,
+)
+
+
+def learn_codes(db, code_filter: CodeFilter, codes: List[str]) -> None:
+    """Teach ``code_filter`` the ``codes`` inserted through ``db``.
+
+    The local filter learns them at once, a rolled back insert only costs
+    a few false positives. Other workers learn them on commit, a rebuild
+    until the transaction ends.
+    """
+    if code_filter.enabled and codes:
+        code_filter.learn(codes)
+        new_codes = db.info.get('new_codes')
+        if new_codes is None:
+            new_codes = db.info['new_codes'] = []
+            UNCOMMITTED[id(new_codes)] = new_codes
+        new_codes.extend(codes)
+
+
+def payloads(codes: List[str]) -> Iterable[str]:
+    """JSON arrays of ``codes`` that fit a NOTIFY payload each."""
+    chunk: List[str] = []
+    size = 2
+    for code in codes:
+        length = len(json.dumps(code).encode()) + 1
+        if chunk and size + length > MAX_PAYLOAD_BYTES:
+            yield json.dumps(chunk, separators=(',', ':'))
+            chunk, size = [], 2
+        chunk.append(code)
+        size += length
+    if chunk:
+        yield json.dumps(chunk, separators=(',', ':'))
+
+
+NOTIFY_CODES = text(
+    'SELECT pg_notify(:channel, payload) '
+    'FROM unnest(CAST(:payloads AS text[])) AS payload'
+)
+
+
+@event.listens_for(Session, 'before_commit')
+def notify_codes(session: Session) -> None:
+    codes = session.info.get('new_codes')
+    if codes and session.get_bind().dialect.name == 'postgresql':
+        session.execute(
+            NOTIFY_CODES,
+            {'channel': CHANNEL, 'payloads': list(payloads(codes))},
+        )
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def drop_codes(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        codes = session.info.pop('new_codes', None)
+        if codes is not None:
+            UNCOMMITTED.pop(id(codes), None)
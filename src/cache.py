@@ -0,0 +1,131 @@
+"""Bounded in-process LRU/TTL caches for the scan path.
+
+Writes that depend on uncommitted data are staged on the session with
+:func:`stage` and only reach the cache once the transaction commits, so a
+rolled back request never leaves a stale entry behind.
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Hashable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .metrics import REGISTRY
+from .settings import (CACHE_ENABLED, CACHE_MAXSIZE, CACHE_NEGATIVE_TTL,
+                       CACHE_TTL)
+
+MISSING = object()
+
+CACHE_HITS = REGISTRY.counter('cache_hits_total', 'Cache lookups answered.')
+CACHE_MISSES = REGISTRY.counter('cache_misses_total', 'Cache lookups missed.')
+CACHE_EVICTIONS = REGISTRY.counter(
+    'cache_evictions_total', 'Entries evicted because the cache was full.'
+)
+
+
+class LRUCache:
+    """LRU cache with per-entry expiry; ``maxsize=0`` disables it."""
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        ttl: float,
+        negative_ttl: Optional[float] = None
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        if not self.maxsize:
+            return MISSING
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                CACHE_MISSES.inc(cache=self.name)
+                return MISSING
+            self._entries.move_to_end(key)
+        CACHE_HITS.inc(cache=self.name)
+        return entry[1]
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl: Optional[float] = None
+    ) -> None:
+        """Store ``value``; None is cached as a short-lived negative entry."""
+        if not self.maxsize:
+            return
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                CACHE_EVICTIONS.inc(cache=self.name)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+# code -> crud.ProductState, or None for codes known to be missing.
+PRODUCT_CACHE = LRUCache(
+    'product',
+    CACHE_MAXSIZE if CACHE_ENABLED else 0,
+    CACHE_TTL,
+    CACHE_NEGATIVE_TTL,
+)
+# (date, number) -> batch id.
+BATCH_KEY_CACHE = LRUCache(
+    'batch_key',
+    CACHE_MAXSIZE if CACHE_ENABLED else 0,
+    CACHE_TTL,
+)
+
+
+def stage(db, cache: LRUCache, key: Hashable, value: Any = MISSING) -> None:
+    """Set (or, without ``value``, invalidate) ``key`` once ``db`` commits.
+
+    Invalidations also apply immediately, so nothing reads the old entry
+    while the transaction is still open.
+    """
+    if not cache.maxsize:
+        return
+    if value is MISSING:
+        cache.invalidate(key)
+    db.info.setdefault('cache_writes', []).append((cache, key, value))
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_staged_writes(session: Session) -> None:
+    for cache, key, value in session.info.pop('cache_writes', ()):
+        if value is MISSING:
+            cache.invalidate(key)
+        else:
+            cache.set(key, value)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def drop_staged_writes(session: Session, transaction) -> None:
+    # Runs after after_commit, and on rollback or close without a commit.
+    if transaction.parent is None:
+        session.info.pop('cache_writes', None)
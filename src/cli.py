@@ -0,0 +1,139 @@
+"""Maintenance commands, run as ``python -m src.cli <command>``."""
+import argparse
+import asyncio
+from datetime import date, datetime, timedelta
+from time import perf_counter
+from typing import List, Optional
+
+from sqlalchemy import select
+
+from . import archive, crud, partitions
+from .database import SessionLocal, engine
+from .idempotency import DatabaseStore
+from .models import Batch
+from .settings import (ARCHIVE_AFTER_DAYS, ARCHIVE_CHUNK_SIZE,
+                       PARTITIONS_MONTHS_AHEAD)
+
+
+async def recount(batch_ids: List[int], chunk_size: int) -> None:
+    async with SessionLocal() as db:
+        if not batch_ids:
+            batch_ids = (
+                await db.scalars(select(Batch.id).order_by(Batch.id))
+            ).all()
+        repaired = 0
+        for chunk in crud.chunked(batch_ids, chunk_size):
+            repaired += await crud.recount_batches(db, chunk)
+            await db.commit()
+    await engine.dispose()
+    print(f'{len(batch_ids)} batches recounted, {repaired} repaired')
+
+
+async def archive_batches(older_than_days: int, chunk_size: int) -> None:
+    closed_before = datetime.now() - timedelta(days=older_than_days)
+    batches = products = 0
+    started = perf_counter()
+    async with SessionLocal() as db:
+        while True:
+            moved_batches, moved_products = await archive.archive_batches(
+                db, closed_before, chunk_size
+            )
+            await db.commit()
+            if not moved_batches:
+                break
+            batches += moved_batches
+            products += moved_products
+            elapsed = perf_counter() - started
+            print(
+                f'{batches} batches, {products} products archived, '
+                f'{(batches + products) / elapsed:.0f} rows/s'
+            )
+    await engine.dispose()
+    print(f'{batches} batches and {products} products archived '
+          f'in {perf_counter() - started:.1f}s')
+
+
+async def create_partitions(months_ahead: int) -> None:
+    async with engine.begin() as conn:
+        created = await partitions.create_partitions(
+            conn, date.today(), months_ahead + 1
+        )
+    await engine.dispose()
+    print(f'{len(created)} partitions created: {", ".join(created)}')
+
+
+async def detach_partitions(before: date, lock_timeout_ms: int) -> None:
+    async with engine.begin() as conn:
+        detached = await partitions.detach_partitions(
+            conn, before, lock_timeout_ms
+        )
+    await engine.dispose()
+    print(f'{len(detached)} partitions detached: {", ".join(detached)}')
+
+
+async def evict_idempotency_keys() -> None:
+    evicted = await DatabaseStore(SessionLocal).evict()
+    await engine.dispose()
+    print(f'{evicted} expired idempotency keys evicted')
+
+
+def month(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m src.cli')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser(
+        'recount', help='rebuild batch product counters from product rows'
+    )
+    command.add_argument(
+        '--batch-id', type=int, action='append', default=[], dest='batch_ids'
+    )
+    command.add_argument('--chunk-size', type=int, default=1000)
+    command = commands.add_parser(
+        'archive',
+        help='move long-closed batches and their products to the archive',
+    )
+    command.add_argument(
+        '--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS
+    )
+    command.add_argument('--chunk-size', type=int, default=ARCHIVE_CHUNK_SIZE)
+    command = commands.add_parser(
+        'partitions', help='manage monthly product partitions (PostgreSQL)'
+    )
+    actions = command.add_subparsers(dest='action', required=True)
+    action = actions.add_parser(
+        'create', help='create partitions up to N months ahead'
+    )
+    action.add_argument(
+        '--months-ahead', type=int, default=PARTITIONS_MONTHS_AHEAD
+    )
+    action = actions.add_parser(
+        'detach', help='detach partitions of months before YYYY-MM'
+    )
+    action.add_argument('--before', type=month, required=True)
+    action.add_argument('--lock-timeout-ms', type=int, default=2000)
+    commands.add_parser(
+        'evict-idempotency-keys',
+        help='delete expired Idempotency-Key responses; run it from cron',
+    )
+    arguments = parser.parse_args(argv)
+    if arguments.command == 'recount':
+        asyncio.run(recount(arguments.batch_ids, arguments.chunk_size))
+    elif arguments.command == 'archive':
+        asyncio.run(archive_batches(
+            arguments.older_than_days, arguments.chunk_size
+        ))
+    elif arguments.command == 'evict-idempotency-keys':
+        asyncio.run(evict_idempotency_keys())
+    elif arguments.action == 'create':
+        asyncio.run(create_partitions(arguments.months_ahead))
+    else:
+        asyncio.run(detach_partitions(
+            arguments.before, arguments.lock_timeout_ms
+        ))
+
+
+if __name__ == '__main__':
+    main()
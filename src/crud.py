@@ -0,0 +1,654 @@
+"""Database operations of the API. None of them commit, callers do."""
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import (Boolean, and_, bindparam, case, func, insert,
+                        literal_column, not_, or_, select, tuple_, update)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .bloom import CODE_FILTER, learn_codes
+from .cache import BATCH_KEY_CACHE, MISSING, PRODUCT_CACHE, stage
+from .events import mark_changed
+from .filters import BatchFilters
+from .models import Batch, Product, ProductArchive, ProductCode
+from .schemas import (Aggregation, AggregationResult, AggregationStats,
+                      AggregationStatus, BatchCreate, BatchImportReport,
+                      IngestStatus, ProductCreate, ProductIngestItem,
+                      ProductIngestReport, ProductRead, StatsGroup)
+from .settings import (AGGREGATION_CHUNK_SIZE, BATCH_UPSERT_CHUNK_SIZE,
+                       PRODUCT_INSERT_CHUNK_SIZE)
+
+DIALECT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def chunked(items: Sequence, size: int) -> Iterable[Sequence]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def dialect_insert(db: AsyncSession, model):
+    """INSERT construct supporting ON CONFLICT for the session's dialect."""
+    return DIALECT_INSERTS[db.get_bind().dialect.name](model)
+
+
+async def add_product_counts(
+    db: AsyncSession,
+    counts: Dict[int, int],
+    aggregated_at: Optional[datetime] = None
+) -> None:
+    """Add ``counts`` (batch id -> products) to the batch counters.
+
+    Without ``aggregated_at`` the products are new, otherwise they were
+    just aggregated at that time. Batches are updated in id order so
+    concurrent requests lock them in the same order.
+    """
+    if not counts:
+        return
+    mark_changed(db, counts)
+    table = Batch.__table__
+    if aggregated_at is None:
+        values = {'product_count': table.c.product_count + bindparam('added')}
+    else:
+        incremented = table.c.aggregated_count + bindparam('added')
+        values = {
+            'aggregated_count': incremented,
+            'last_aggregated_at': case(
+                (
+                    table.c.last_aggregated_at >= aggregated_at,
+                    table.c.last_aggregated_at,
+                ),
+                else_=aggregated_at,
+            ),
+        }
+    await db.execute(
+        update(table)
+        .where(table.c.id == bindparam('batch_id'))
+        .values(values),
+        [
+            {'batch_id': batch_id, 'added': added}
+            for batch_id, added in sorted(counts.items())
+        ],
+    )
+
+
+async def recount_batches(db: AsyncSession, batch_ids: Sequence[int]) -> int:
+    """Rebuild drifted counters of ``batch_ids``; returns how many."""
+    table = Batch.__table__
+    # Correlating on the date as well keeps each subquery to one partition.
+    of_batch = and_(
+        Product.batch_id == table.c.id, Product.date == table.c.date
+    )
+    products = select(func.count()).select_from(Product).where(of_batch)
+    aggregated = products.where(Product.is_aggregated)
+    counters = {
+        'product_count': products.scalar_subquery(),
+        'aggregated_count': aggregated.scalar_subquery(),
+        'last_aggregated_at': select(
+            func.max(Product.aggregated_at)
+        ).where(of_batch).scalar_subquery(),
+    }
+    result = await db.execute(
+        update(table)
+        .where(
+            table.c.id.in_(batch_ids),
+            or_(*(
+                table.c[name].is_distinct_from(value)
+                for name, value in counters.items()
+            )),
+        )
+        .values(counters)
+    )
+    return result.rowcount
+
+
+async def move_batch_products(
+    db: AsyncSession,
+    batch: Batch,
+    old_date: date
+) -> None:
+    """Carry the products of ``batch`` over to its new date and number.
+
+    Run it before loading ``batch.products``, which a flush would otherwise
+    move one by one.
+    """
+    table = Product.__table__
+    of_batch = and_(
+        table.c.batch_id == batch.id, table.c.date == old_date
+    )
+    await db.execute(
+        update(ProductCode.__table__)
+        .where(ProductCode.code.in_(select(table.c.code).where(of_batch)))
+        .values(date=batch.date)
+    )
+    await db.execute(
+        update(table)
+        .where(of_batch)
+        .values(date=batch.date, batch_number=batch.number)
+    )
+
+
+STATS_KEYS = {
+    StatsGroup.batch: (
+        Batch.id.label('batch_id'), Batch.number, Batch.date,
+        Batch.line, Batch.shift,
+    ),
+    StatsGroup.line: (Batch.line,),
+    StatsGroup.shift: (Batch.shift,),
+    StatsGroup.date: (Batch.date,),
+}
+
+
+async def aggregation_stats(
+    db: AsyncSession,
+    filters: BatchFilters,
+    group_by: StatsGroup,
+    limit: int,
+    offset: int
+) -> List[AggregationStats]:
+    """Product totals per ``group_by`` key, summed from the batch counters."""
+    keys = STATS_KEYS[group_by]
+    rows = await db.execute(
+        filters.apply(select(
+            *keys,
+            func.sum(Batch.product_count).label('total'),
+            func.sum(Batch.aggregated_count).label('aggregated'),
+        ))
+        .group_by(*keys)
+        .order_by(*keys)
+        .offset(offset)
+        .limit(limit)
+    )
+    stats = []
+    for row in rows.mappings():
+        row = dict(row)
+        # PostgreSQL sums bigints into numeric.
+        row['total'], row['aggregated'] = (
+            int(row['total']), int(row['aggregated'])
+        )
+        stats.append(AggregationStats(
+            **row, remaining=row['total'] - row['aggregated']
+        ))
+    return stats
+
+
+async def resolve_batch_ids(
+    db: AsyncSession,
+    keys: Iterable[Tuple[date, int]],
+    cached: bool = True
+) -> Dict[Tuple[date, int], int]:
+    """Map (date, number) pairs to batch ids, via the cache if ``cached``."""
+    batch_ids = {}
+    missing = []
+    for key in keys:
+        batch_id = BATCH_KEY_CACHE.get(key) if cached else MISSING
+        if batch_id is MISSING:
+            missing.append(key)
+        else:
+            batch_ids[key] = batch_id
+    for chunk in chunked(missing, PRODUCT_INSERT_CHUNK_SIZE):
+        rows = await db.execute(
+            select(Batch.date, Batch.number, Batch.id)
+            .where(tuple_(Batch.date, Batch.number).in_(chunk))
+            .order_by(Batch.id)
+        )
+        for batch_date, number, batch_id in rows:
+            if (batch_date, number) not in batch_ids:
+                batch_ids[(batch_date, number)] = batch_id
+                BATCH_KEY_CACHE.set((batch_date, number), batch_id)
+    if not cached:
+        for key in missing:
+            if key not in batch_ids:
+                BATCH_KEY_CACHE.invalidate(key)
+    return batch_ids
+
+
+async def ingest_products(
+    db: AsyncSession,
+    products: List[ProductCreate]
+) -> ProductIngestReport:
+    """Insert products in bulk, skipping duplicates and unknown batches.
+
+    A batch deleted since its id was resolved, such as through a stale cache
+    entry, rolls the transaction back for one retry without the cache.
+    """
+    keys = {(product.date, product.batch_number) for product in products}
+    try:
+        return await store_products(
+            db, products, await resolve_batch_ids(db, keys)
+        )
+    except IntegrityError:
+        await db.rollback()
+    return await store_products(
+        db, products, await resolve_batch_ids(db, keys, cached=False)
+    )
+
+
+async def store_products(
+    db: AsyncSession,
+    products: List[ProductCreate],
+    batch_ids: Dict[Tuple[date, int], int]
+) -> ProductIngestReport:
+    items = []
+    pending = []
+    rows = {}
+    for product in products:
+        batch_id = batch_ids.get((product.date, product.batch_number))
+        if batch_id is None:
+            items.append(ProductIngestItem(
+                code=product.code, status=IngestStatus.batch_not_found
+            ))
+            continue
+        item = ProductIngestItem(
+            code=product.code,
+            status=IngestStatus.duplicate,
+            batch_id=batch_id,
+        )
+        items.append(item)
+        if product.code not in rows:
+            pending.append(item)
+            rows[product.code] = {
+                'code': product.code,
+                'batch_number': product.batch_number,
+                'date': product.date,
+                'is_aggregated': False,
+                'batch_id': batch_id,
+            }
+
+    created = {}
+    claim_codes = dialect_insert(
+        db, ProductCode.__table__
+    ).on_conflict_do_nothing(
+        index_elements=[ProductCode.code]
+    ).returning(ProductCode.code)
+    insert_products = insert(Product.__table__).returning(
+        Product.code, Product.id
+    )
+    for chunk in chunked(list(rows.values()), PRODUCT_INSERT_CHUNK_SIZE):
+        result = await db.execute(claim_codes, [
+            {'code': row['code'], 'date': row['date']} for row in chunk
+        ])
+        claimed = set(result.scalars().all())
+        learn_codes(db, CODE_FILTER, list(claimed))
+        fresh = [row for row in chunk if row['code'] in claimed]
+        if fresh:
+            result = await db.execute(insert_products, fresh)
+            created.update(result.tuples().all())
+    counts = defaultdict(int)
+    for item in pending:
+        if item.code in created:
+            item.status = IngestStatus.created
+            item.id = created[item.code]
+            counts[item.batch_id] += 1
+            stage(db, PRODUCT_CACHE, item.code, ProductState(
+                item.batch_id, False, None
+            ))
+    await add_product_counts(db, counts)
+
+    report = ProductIngestReport(items=items)
+    for item in items:
+        if item.status == IngestStatus.created:
+            report.created += 1
+        elif item.status == IngestStatus.duplicate:
+            report.duplicates += 1
+        else:
+            report.batch_not_found += 1
+    return report
+
+
+async def upsert_batches(
+    db: AsyncSession,
+    batches: List[BatchCreate]
+) -> BatchImportReport:
+    """Insert or update batches keyed on (date, number); the last one wins."""
+    now = datetime.now()
+    rows = {}
+    for batch in batches:
+        row = batch.model_dump()
+        row['closed_at'] = now if batch.status else None
+        rows[(batch.date, batch.number)] = row
+
+    table = Batch.__table__
+    insert = dialect_insert(db, table)
+    columns = [
+        name for name in BatchCreate.model_fields
+        if name not in ('date', 'number')
+    ]
+    statement = insert.on_conflict_do_update(
+        index_elements=[table.c.date, table.c.number],
+        set_={
+            **{name: insert.excluded[name] for name in columns},
+            'closed_at': case(
+                (not_(insert.excluded.status), None),
+                (and_(insert.excluded.status, not_(table.c.status)), now),
+                else_=table.c.closed_at,
+            ),
+        },
+        where=or_(*(
+            table.c[name].is_distinct_from(insert.excluded[name])
+            for name in columns
+        )),
+    )
+    # PostgreSQL tells inserted rows from updated ones by xmax, so the upsert
+    # is the only round trip. Other dialects look the keys up beforehand.
+    xmax = db.get_bind().dialect.name == 'postgresql'
+    if xmax:
+        inserted = literal_column('xmax = 0', Boolean)
+    else:
+        inserted = literal_column('NULL', Boolean)
+    statement = statement.returning(
+        table.c.date, table.c.number, inserted.label('inserted')
+    )
+
+    report = BatchImportReport()
+    for key in rows:
+        stage(db, BATCH_KEY_CACHE, key)
+    for chunk in chunked(list(rows), BATCH_UPSERT_CHUNK_SIZE):
+        existing = set()
+        if not xmax:
+            result = await db.execute(
+                select(Batch.date, Batch.number)
+                .where(tuple_(Batch.date, Batch.number).in_(chunk))
+            )
+            existing = set(result.tuples().all())
+        result = await db.execute(statement, [rows[key] for key in chunk])
+        changed = {
+            (batch_date, number): (
+                is_inserted if xmax else (batch_date, number) not in existing
+            )
+            for batch_date, number, is_inserted in result.tuples()
+        }
+        for key in chunk:
+            if key not in changed:
+                report.unchanged += 1
+            elif changed[key]:
+                report.inserted += 1
+            else:
+                report.updated += 1
+    return report
+
+
+class ProductState(NamedTuple):
+    batch_id: Optional[int]
+    is_aggregated: Optional[bool]
+    aggregated_at: Optional[datetime]
+
+
+async def product_states(
+    db: AsyncSession,
+    codes: Sequence[str]
+) -> Dict[str, ProductState]:
+    """Stored state of the known ``codes``; unknown codes are left out.
+
+    Registered codes missing from ``product`` are read from the archive.
+    """
+    table = Product.__table__
+    partition = table.c.date == ProductCode.date
+    if len(codes) == 1:
+        # PostgreSQL prunes on a scalar subquery at execution time, but not
+        # on a join to the one product_code row.
+        partition = table.c.date == select(ProductCode.date).where(
+            ProductCode.code == codes[0]
+        ).scalar_subquery()
+    result = await db.execute(
+        select(
+            ProductCode.code,
+            table.c.id,
+            table.c.batch_id,
+            table.c.is_aggregated,
+            table.c.aggregated_at,
+        )
+        .select_from(ProductCode)
+        .outerjoin(table, and_(table.c.code == ProductCode.code, partition))
+        .where(ProductCode.code.in_(codes))
+    )
+    states = {}
+    archived = []
+    for code, product_id, *state in result:
+        if product_id is None:
+            archived.append(code)
+        else:
+            states[code] = ProductState(*state)
+    if archived:
+        archive = ProductArchive.__table__
+        result = await db.execute(
+            select(
+                archive.c.code,
+                archive.c.batch_id,
+                archive.c.is_aggregated,
+                archive.c.aggregated_at,
+            ).where(archive.c.code.in_(archived))
+        )
+        for code, *state in result:
+            states[code] = ProductState(*state)
+    return states
+
+
+def rejects(product: Optional[ProductState], batch_id: int) -> bool:
+    """Whether aggregating into ``batch_id`` is bound to fail."""
+    return (
+        product is None
+        or bool(product.is_aggregated)
+        or product.batch_id != batch_id
+    )
+
+
+def classify_aggregation(
+    code: str,
+    batch_id: int,
+    product: Optional[ProductState]
+) -> AggregationResult:
+    """Explain why ``code`` could not be aggregated into ``batch_id``."""
+    if product is None:
+        return AggregationResult(code=code, status=AggregationStatus.not_found)
+    if product.is_aggregated:
+        return AggregationResult(
+            code=code,
+            status=AggregationStatus.already_aggregated,
+            aggregated_at=product.aggregated_at,
+        )
+    if product.batch_id != batch_id:
+        return AggregationResult(
+            code=code, status=AggregationStatus.wrong_batch
+        )
+    # Only reachable when the code was inserted between the UPDATE and this
+    # read; the scanner has to retry, exactly as for an unknown code.
+    return AggregationResult(code=code, status=AggregationStatus.not_found)
+
+
+async def known_states(
+    codes: Iterable[str]
+) -> Dict[str, Optional[ProductState]]:
+    """States of ``codes`` known without a query: cached ones, and None for
+    codes the code filter has never seen.
+    """
+    states = {}
+    for code in codes:
+        if code not in states:
+            states[code] = PRODUCT_CACHE.get(code)
+    unknown = await CODE_FILTER.missing(
+        code for code, state in states.items() if state is MISSING
+    )
+    for code in unknown:
+        states[code] = None
+    return {
+        code: state for code, state in states.items() if state is not MISSING
+    }
+
+
+def known_rejection(
+    aggregation: Aggregation,
+    known: Dict[str, Optional[ProductState]]
+) -> Optional[AggregationResult]:
+    """The answer to ``aggregation`` if the ``known`` states reject it."""
+    state = known.get(aggregation.code, MISSING)
+    if state is not MISSING and rejects(state, aggregation.id):
+        return classify_aggregation(aggregation.code, aggregation.id, state)
+    return None
+
+
+async def aggregate_product(
+    db: AsyncSession,
+    aggregation: Aggregation,
+    known: Optional[Dict[str, Optional[ProductState]]] = None
+) -> AggregationResult:
+    """Mark a product aggregated with a single conditional UPDATE.
+
+    Codes the ``known`` states reject are answered without a statement.
+    """
+    if known is None:
+        known = await known_states([aggregation.code])
+    rejection = known_rejection(aggregation, known)
+    if rejection is not None:
+        return rejection
+    table = Product.__table__
+    batch_date = select(Batch.date).where(Batch.id == aggregation.id)
+    result = await db.execute(
+        update(table)
+        .where(
+            table.c.code == aggregation.code,
+            table.c.batch_id == aggregation.id,
+            table.c.date == batch_date.scalar_subquery(),
+            table.c.is_aggregated.is_not(True),
+        )
+        .values(is_aggregated=True, aggregated_at=datetime.now())
+        .returning(*table.c)
+    )
+    row = result.mappings().first()
+    if row is not None:
+        await add_product_counts(
+            db, {aggregation.id: 1}, row['aggregated_at']
+        )
+        stage(db, PRODUCT_CACHE, aggregation.code, ProductState(
+            aggregation.id, True, row['aggregated_at']
+        ))
+        return AggregationResult(
+            code=aggregation.code,
+            status=AggregationStatus.aggregated,
+            aggregated_at=row['aggregated_at'],
+            product=ProductRead.model_validate(row),
+        )
+    state = (await product_states(db, [aggregation.code])).get(
+        aggregation.code
+    )
+    if state is None:
+        CODE_FILTER.missed(1)
+    PRODUCT_CACHE.set(aggregation.code, state)
+    return classify_aggregation(aggregation.code, aggregation.id, state)
+
+
+async def aggregate_products(
+    db: AsyncSession,
+    aggregations: List[Aggregation],
+    products: bool = False,
+    known: Optional[Dict[str, Optional[ProductState]]] = None
+) -> List[AggregationResult]:
+    """Aggregate a scanner buffer with set-based statements.
+
+    Results are those of scanning the buffer one code after another. With
+    ``products`` aggregated results carry the updated product.
+    """
+    table = Product.__table__
+    now = datetime.now()
+    # (code, batch id) pairs that may aggregate, in buffer order, and codes
+    # no scan of this buffer can aggregate.
+    pending = {}
+    settled = set()
+    states = {}
+    if known is None:
+        known = await known_states(
+            aggregation.code for aggregation in aggregations
+        )
+    for aggregation in aggregations:
+        key = (aggregation.code, aggregation.id)
+        if key in pending or aggregation.code in settled:
+            continue
+        if known_rejection(aggregation, known) is None:
+            pending[key] = None
+            continue
+        state = known[aggregation.code]
+        states[aggregation.code] = state
+        if state is None or state.is_aggregated:
+            settled.add(aggregation.code)
+
+    batch_dates = {}
+    if pending:
+        batch_ids = {batch_id for _, batch_id in pending}
+        result = await db.execute(
+            select(Batch.id, Batch.date).where(Batch.id.in_(batch_ids))
+        )
+        batch_dates = dict(result.tuples().all())
+
+    # code -> batch it was aggregated into by this buffer
+    fresh = {}
+    updated = {}
+    for chunk in chunked(list(pending), AGGREGATION_CHUNK_SIZE):
+        codes = list(dict.fromkeys(code for code, _ in chunk))
+        # Codes of unknown batches match nothing and are explained below.
+        keys = [
+            (code, batch_id, batch_dates[batch_id])
+            for code, batch_id in chunk
+            if batch_id in batch_dates
+        ]
+        if keys:
+            columns = table.c if products else [
+                table.c.code, table.c.batch_id
+            ]
+            result = await db.execute(
+                update(table)
+                .where(
+                    table.c.code.in_(codes),
+                    tuple_(table.c.code, table.c.batch_id, table.c.date)
+                    .in_(keys),
+                    table.c.is_aggregated.is_not(True),
+                )
+                .values(is_aggregated=True, aggregated_at=now)
+                .returning(*columns)
+            )
+            for row in result.mappings():
+                fresh[row['code']] = row['batch_id']
+                stage(db, PRODUCT_CACHE, row['code'], ProductState(
+                    row['batch_id'], True, now
+                ))
+                if products:
+                    updated[row['code']] = ProductRead.model_validate(row)
+        rejected = [code for code in codes if code not in fresh]
+        if rejected:
+            known = await product_states(db, rejected)
+            CODE_FILTER.missed(len(rejected) - len(known))
+            states.update(known)
+            for code in rejected:
+                PRODUCT_CACHE.set(code, states.get(code))
+
+    counts = defaultdict(int)
+    for batch_id in fresh.values():
+        counts[batch_id] += 1
+    await add_product_counts(db, counts, now)
+
+    results = []
+    reported = set()
+    for aggregation in aggregations:
+        code = aggregation.code
+        batch_id = fresh.get(code)
+        if batch_id is None:
+            state = states.get(code)
+        elif code in reported:
+            state = ProductState(batch_id, True, now)
+        elif batch_id != aggregation.id:
+            state = ProductState(batch_id, False, None)
+        else:
+            reported.add(code)
+            results.append(AggregationResult(
+                code=code,
+                status=AggregationStatus.aggregated,
+                aggregated_at=now,
+                product=updated.get(code),
+            ))
+            continue
+        results.append(classify_aggregation(code, aggregation.id, state))
+    return results
@@ -1,18 +1,310 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+from contextlib import AsyncExitStack
+from time import monotonic, perf_counter
+from typing import Optional
 
-from .settings import DB_HOST, DB_PASS, DB_PORT, DB_USER
+from fastapi import Depends, HTTPException
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import (AsyncConnection, AsyncEngine, AsyncSession,
+                                    async_sessionmaker, create_async_engine)
+from sqlalchemy.pool import QueuePool
 
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/postgres"
+from .instrumentation import instrument_queries
+from .metrics import REGISTRY
+from .settings import (DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_PRE_PING,
+                       DB_POOL_RECYCLE, DB_POOL_SIZE, DB_POOL_TIMEOUT,
+                       DB_STATEMENT_TIMEOUT_MS, REPLICA_CHECK_INTERVAL,
+                       REPLICA_CHECK_TIMEOUT, REPLICA_DATABASE_URL,
+                       REPLICA_MAX_LAG)
 
-engine = create_engine(DATABASE_URL)
+# Raised when a database cannot be reached at all.
+CONNECT_ERRORS = (OSError, DBAPIError, asyncio.TimeoutError)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+POOL_CHECKOUT_SECONDS = REGISTRY.histogram(
+    'db_pool_checkout_seconds',
+    'Time spent waiting for a pooled connection.',
+)
+POOL_OVERFLOW_TOTAL = REGISTRY.counter(
+    'db_pool_overflow_connections_total',
+    'Connections opened beyond pool_size.',
+)
+POOL_TIMEOUTS_TOTAL = REGISTRY.counter(
+    'db_pool_timeouts_total',
+    'Requests rejected because no connection was free in time.',
+)
+REPLICA_FALLBACKS_TOTAL = REGISTRY.counter(
+    'db_replica_fallbacks_total',
+    'Reads sent to the primary because the replica was down or lagging.',
+)
 
 
-def get_db():
-    db = SessionLocal()
+def engine_options(url: str) -> dict:
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        return {}
+    options = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS and url.get_driver_name() == 'asyncpg':
+        options['connect_args'] = {'server_settings': {
+            'statement_timeout': str(DB_STATEMENT_TIMEOUT_MS),
+        }}
+    return options
+
+
+def instrument_pool(engine: AsyncEngine) -> None:
+    pool = engine.sync_engine.pool
+
+    @event.listens_for(pool, 'connect')
+    def count_overflow(dbapi_connection, connection_record):
+        if isinstance(pool, QueuePool) and pool.overflow() > 0:
+            POOL_OVERFLOW_TOTAL.inc()
+
+
+def pool_status(engine: AsyncEngine) -> dict:
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return {'size': 0, 'checked_out': 0, 'overflow': 0, 'saturation': 0}
+    capacity = pool.size() + DB_MAX_OVERFLOW
+    checked_out = pool.checkedout()
+    return {
+        'size': pool.size(),
+        'checked_out': checked_out,
+        'overflow': max(pool.overflow(), 0),
+        'saturation': checked_out / capacity if capacity > 0 else 0,
+    }
+
+
+async def warm_pool(engine: AsyncEngine, size: int) -> int:
+    """Open up to ``size`` pooled connections so first requests skip it.
+
+    The connections are held together, so each one is a new connection,
+    and returned to the pool at the end. Returns how many were opened.
+    """
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return 0
+    size = min(size, pool.size())
+    async with AsyncExitStack() as stack:
+        for _ in range(size):
+            connection = await stack.enter_async_context(engine.connect())
+            await connection.execute(text('SELECT 1'))
+    return size
+
+
+async def replication_lag(connection: AsyncConnection) -> float:
+    """Seconds the database is behind its primary, 0 for a primary."""
+    if connection.dialect.name != 'postgresql':
+        return 0.0
+    # An idle primary sends nothing to replay, so a replica that replayed
+    # everything it received is up to date however old its last commit.
+    lag = await connection.scalar(text("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery()
+                OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+            THEN 0
+            ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """))
+    return float(lag or 0)
+
+
+class Replica:
+    """Read-only copy of the database, used while it keeps up.
+
+    Availability and lag are checked at most every ``check_interval``
+    seconds; until the next check reads go where the last one decided.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        max_lag: float,
+        check_interval: float
+    ):
+        self.engine = engine
+        self.sessions = async_sessionmaker(
+            bind=engine, autoflush=False, expire_on_commit=False
+        )
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag: Optional[float] = None
+        self.usable = False
+        self.checked_at = float('-inf')
+
+    async def available(self) -> bool:
+        if monotonic() - self.checked_at < self.check_interval:
+            return self.usable
+        # Set first, so concurrent requests keep the previous answer
+        # instead of all checking at once.
+        self.checked_at = monotonic()
+        try:
+            async with self.engine.connect() as connection:
+                self.lag = await asyncio.wait_for(
+                    replication_lag(connection), REPLICA_CHECK_TIMEOUT
+                )
+        except CONNECT_ERRORS:
+            self.lag = None
+        self.usable = self.lag is not None and self.lag <= self.max_lag
+        return self.usable
+
+    def mark_down(self) -> None:
+        self.lag = None
+        self.usable = False
+        self.checked_at = monotonic()
+
+
+def create_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, **engine_options(url))
+    instrument_pool(engine)
+    instrument_queries(engine)
+    return engine
+
+
+# ``engine``, ``SessionLocal`` and ``replica`` are created on first use
+# (see the module ``__getattr__`` below), not at import: tests and tools
+# that never query do not build a pool, and workers create theirs in the
+# application lifespan.
+def get_engine() -> AsyncEngine:
+    global engine
+    if 'engine' not in globals():
+        engine = create_engine(DATABASE_URL)
+    return engine
+
+
+def get_sessionmaker() -> async_sessionmaker:
+    """Session factory for work that outlives the request, like streaming."""
+    global SessionLocal
+    if 'SessionLocal' not in globals():
+        SessionLocal = async_sessionmaker(
+            bind=get_engine(),
+            autoflush=False,
+            expire_on_commit=False,
+        )
+    return SessionLocal
+
+
+def get_replica() -> Optional[Replica]:
+    global replica
+    if 'replica' not in globals():
+        replica = None
+        if REPLICA_DATABASE_URL:
+            replica = Replica(
+                create_engine(REPLICA_DATABASE_URL),
+                REPLICA_MAX_LAG,
+                REPLICA_CHECK_INTERVAL,
+            )
+    return replica
+
+
+LAZY = {
+    'engine': get_engine,
+    'SessionLocal': get_sessionmaker,
+    'replica': get_replica,
+}
+
+
+def __getattr__(name: str):
+    if name in LAZY:
+        return LAZY[name]()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+async def dispose_engines() -> None:
+    """Close the pools and forget them, the next use creates new ones."""
+    primary = globals().pop('engine', None)
+    globals().pop('SessionLocal', None)
+    standby = globals().pop('replica', None)
+    if primary is not None:
+        await primary.dispose()
+    if standby is not None:
+        await standby.engine.dispose()
+
+
+def replica_lag() -> float:
+    standby = get_replica()
+    return -1 if standby is None or standby.lag is None else standby.lag
+
+
+REGISTRY.gauge(
+    'db_pool_checked_out',
+    'Connections currently checked out of the pool.',
+    lambda: pool_status(get_engine())['checked_out'],
+)
+REGISTRY.gauge(
+    'db_pool_overflow',
+    'Connections currently open beyond pool_size.',
+    lambda: pool_status(get_engine())['overflow'],
+)
+REGISTRY.gauge(
+    'db_replica_lag_seconds',
+    'Replication lag at the last check, -1 if unknown or unconfigured.',
+    replica_lag,
+)
+
+
+async def checkout(db: AsyncSession) -> None:
+    started = perf_counter()
     try:
+        await db.connection()
+    except PoolTimeoutError:
+        POOL_TIMEOUTS_TOTAL.inc()
+        raise HTTPException(
+            status_code=503,
+            detail="Database connection pool is exhausted"
+        )
+    POOL_CHECKOUT_SECONDS.observe(perf_counter() - started)
+
+
+async def get_db():
+    async with get_sessionmaker()() as db:
+        await checkout(db)
+        yield db
+
+
+async def get_read_sessionmaker(
+    primary: async_sessionmaker = Depends(get_sessionmaker)
+) -> async_sessionmaker:
+    """The replica's session factory while it is usable, else the primary.
+
+    Reads through it may miss the last ``REPLICA_MAX_LAG`` seconds of
+    writes, so only read-only endpoints use it.
+    """
+    replica = get_replica()
+    if replica is None:
+        return primary
+    if await replica.available():
+        return replica.sessions
+    REPLICA_FALLBACKS_TOTAL.inc()
+    return primary
+
+
+async def get_read_db(
+    sessions: async_sessionmaker = Depends(get_read_sessionmaker),
+    primary: async_sessionmaker = Depends(get_sessionmaker)
+):
+    """Session for read-only endpoints, see :func:`get_read_sessionmaker`.
+
+    A replica that fails to connect is marked down and the request is
+    served from the primary.
+    """
+    if sessions is not primary:
+        async with sessions() as db:
+            try:
+                await checkout(db)
+            except CONNECT_ERRORS:
+                get_replica().mark_down()
+                REPLICA_FALLBACKS_TOTAL.inc()
+            else:
+                yield db
+                return
+    async with primary() as db:
+        await checkout(db)
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,250 @@
+"""Push feed of batch progress for line dashboards.
+
+Write paths only record which batches changed (:func:`mark_changed`);
+the ids reach the process :data:`FEED` once the transaction commits. The
+feed collects them for ``EVENTS_INTERVAL`` seconds, reads the current
+counters of the changed batches somebody subscribed to in one query and
+hands every subscriber the latest :class:`~src.schemas.BatchProgress`
+per batch. Bursts of scans therefore cost one small read per interval,
+whatever the number of dashboards.
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Set
+
+from sqlalchemy import event, select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
+
+from .bloom import MAX_PAYLOAD_BYTES
+from .metrics import REGISTRY
+from .models import Batch
+from .schemas import BatchProgress
+from .settings import EVENTS_BROKER, EVENTS_INTERVAL, EVENTS_KEEPALIVE
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'batch_changes'
+EVENTS_PUBLISHED = REGISTRY.counter(
+    'batch_events_published_total', 'Batch progress events pushed.'
+)
+
+
+def mark_changed(db, batch_ids: Iterable[int]) -> None:
+    """Publish the state of ``batch_ids`` once ``db`` commits."""
+    db.info.setdefault('changed_batches', set()).update(batch_ids)
+
+
+def payloads(batch_ids: Iterable[int]) -> Iterable[str]:
+    """Comma-separated ``batch_ids`` that fit a NOTIFY payload each."""
+    chunk: List[str] = []
+    size = 0
+    for batch_id in batch_ids:
+        item = str(batch_id)
+        if chunk and size + len(item) + 1 > MAX_PAYLOAD_BYTES:
+            yield ','.join(chunk)
+            chunk, size = [], 0
+        chunk.append(item)
+        size += len(item) + 1
+    if chunk:
+        yield ','.join(chunk)
+
+
+NOTIFY_CHANGED = text(
+    'SELECT pg_notify(:channel, payload) '
+    'FROM unnest(CAST(:payloads AS text[])) AS payload'
+)
+
+
+@event.listens_for(Session, 'before_commit')
+def notify_changed(session: Session) -> None:
+    # NOTIFY is transactional, other workers only hear about the ids once
+    # the commit succeeds.
+    batch_ids = session.info.get('changed_batches')
+    if batch_ids and EVENTS_BROKER == 'postgres':
+        session.execute(
+            NOTIFY_CHANGED,
+            {'channel': CHANNEL, 'payloads': list(payloads(batch_ids))},
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_changed(session: Session) -> None:
+    FEED.changed(session.info.pop('changed_batches', ()))
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def drop_changed(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop('changed_batches', None)
+
+
+class Subscription:
+    """Latest unsent event per batch of one client; never grows further."""
+
+    def __init__(self, batch_ids: Sequence[int], lines: Sequence[str]):
+        self.batch_ids = set(batch_ids)
+        self.lines = set(lines)
+        self.pending: Dict[int, BatchProgress] = {}
+        self.ready = asyncio.Event()
+
+    def wants(self, progress: BatchProgress) -> bool:
+        return progress.id in self.batch_ids or progress.line in self.lines
+
+    def put(self, progress: BatchProgress) -> None:
+        self.pending[progress.id] = progress
+        self.ready.set()
+
+    async def get(self, timeout: float) -> List[BatchProgress]:
+        """Wait up to ``timeout`` seconds for events; [] on timeout."""
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.ready.clear()
+        events, self.pending = list(self.pending.values()), {}
+        return events
+
+
+class Feed:
+    def __init__(self, interval: float, broker: str):
+        self.interval = interval
+        self.broker = broker
+        self.subscriptions: Set[Subscription] = set()
+        self.dirty: Set[int] = set()
+        self.sessions: Optional[async_sessionmaker] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def changed(self, batch_ids: Iterable[int]) -> None:
+        # Nobody listens, nothing to remember.
+        if self.subscriptions:
+            self.dirty.update(batch_ids)
+
+    async def snapshot(self, condition) -> List[BatchProgress]:
+        async with self.sessions() as db:
+            rows = await db.execute(
+                select(
+                    Batch.id, Batch.number, Batch.date, Batch.line,
+                    Batch.status, Batch.closed_at, Batch.product_count,
+                    Batch.aggregated_count, Batch.last_aggregated_at,
+                ).where(condition)
+            )
+            return [
+                BatchProgress.model_validate(row, from_attributes=True)
+                for row in rows
+            ]
+
+    async def flush(self) -> None:
+        dirty, self.dirty = self.dirty, set()
+        if not dirty:
+            return
+        batch_ids = set().union(*(s.batch_ids for s in self.subscriptions))
+        if not any(s.lines for s in self.subscriptions):
+            dirty &= batch_ids
+            if not dirty:
+                return
+        # With line subscriptions every changed batch is read, its line is
+        # only known afterwards.
+        for progress in await self.snapshot(Batch.id.in_(dirty)):
+            for subscription in self.subscriptions:
+                if subscription.wants(progress):
+                    subscription.put(progress)
+                    EVENTS_PUBLISHED.inc()
+
+    async def run(self) -> None:
+        listener = None
+        if self.broker == 'postgres':
+            listener = asyncio.create_task(self.listen())
+        try:
+            while self.subscriptions:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.exception('batch progress flush failed')
+        finally:
+            self.dirty = set()
+            if listener is not None:
+                listener.cancel()
+
+    async def listen(self) -> None:
+        """Feed ids that other processes ``pg_notify`` into :attr:`dirty`."""
+        def on_notify(connection, pid, channel, payload):
+            self.changed(int(batch_id) for batch_id in payload.split(','))
+
+        engine = self.sessions.kw['bind']
+        while True:
+            try:
+                async with engine.connect() as connection:
+                    raw = await connection.get_raw_connection()
+                    await raw.driver_connection.add_listener(
+                        CHANNEL, on_notify
+                    )
+                    try:
+                        await asyncio.Future()
+                    finally:
+                        await raw.driver_connection.remove_listener(
+                            CHANNEL, on_notify
+                        )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('batch change listener failed, retrying')
+                await asyncio.sleep(1)
+
+    async def subscribe(
+        self,
+        sessions: async_sessionmaker,
+        batch_ids: Sequence[int],
+        lines: Sequence[str]
+    ) -> Subscription:
+        self.sessions = sessions
+        subscription = Subscription(batch_ids, lines)
+        self.subscriptions.add(subscription)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        if batch_ids:
+            # Start from the current state, dashboards need no GET first.
+            try:
+                initial = await self.snapshot(Batch.id.in_(batch_ids))
+            except BaseException:
+                self.unsubscribe(subscription)
+                raise
+            for progress in initial:
+                subscription.put(progress)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+
+
+FEED = Feed(EVENTS_INTERVAL, EVENTS_BROKER)
+
+
+def encode_event(progress: BatchProgress) -> str:
+    return f'event: batch\ndata: {progress.model_dump_json()}\n\n'
+
+
+async def event_stream(
+    sessions: async_sessionmaker,
+    batch_ids: Sequence[int],
+    lines: Sequence[str],
+    keepalive: float = EVENTS_KEEPALIVE
+) -> AsyncIterator[str]:
+    """Server-sent events for ``batch_ids`` and ``lines``.
+
+    Runs until the client disconnects; a comment line every ``keepalive``
+    seconds keeps proxies from closing an idle stream.
+    """
+    subscription = await FEED.subscribe(sessions, batch_ids, lines)
+    try:
+        # Reconnect quickly after a restart.
+        yield 'retry: 1000\n\n'
+        while True:
+            events = await subscription.get(keepalive)
+            if not events:
+                yield ': keepalive\n\n'
+            for progress in events:
+                yield encode_event(progress)
+    finally:
+        FEED.unsubscribe(subscription)
@@ -0,0 +1,87 @@
+"""Streaming NDJSON/CSV export of batches and products.
+
+Rows are read through a server-side cursor in ``EXPORT_CHUNK_SIZE``
+partitions and every partition is encoded into a single response chunk,
+so memory use does not depend on the size of the export.
+"""
+import csv
+import io
+from typing import AsyncIterator, Sequence, Union
+
+import orjson
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select, and_, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from .filters import BatchFilters
+from .models import Batch, Product
+from .schemas import ExportFormat
+from .settings import EXPORT_CHUNK_SIZE
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: 'application/x-ndjson',
+    ExportFormat.csv: 'text/csv',
+}
+
+
+def batches_query(filters: BatchFilters) -> Select:
+    query = select(*Batch.__table__.c)
+    return filters.apply(query).order_by(Batch.date, Batch.id)
+
+
+def products_query(filters: BatchFilters) -> Select:
+    query = select(*Product.__table__.c).join(
+        Batch,
+        and_(Product.batch_id == Batch.id, Product.date == Batch.date),
+    ).where(*filters.date_clauses(Product.date))
+    return filters.apply(query).order_by(Product.id)
+
+
+def encode_ndjson(columns: Sequence[str], rows: Sequence) -> bytes:
+    return b''.join(
+        orjson.dumps(dict(zip(columns, row)), option=orjson.OPT_APPEND_NEWLINE)
+        for row in rows
+    )
+
+
+def encode_csv(rows: Sequence) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue()
+
+
+async def stream_rows(
+    sessions: async_sessionmaker,
+    query: Select,
+    format: ExportFormat
+) -> AsyncIterator[Union[str, bytes]]:
+    # The request's own session is closed before the body is streamed,
+    # so the export holds a session of its own for as long as it runs.
+    async with sessions() as db:
+        result = await db.stream(
+            query.execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        columns = list(result.keys())
+        if format == ExportFormat.csv:
+            yield encode_csv([columns])
+        async for rows in result.partitions():
+            if format == ExportFormat.csv:
+                yield encode_csv(rows)
+            else:
+                yield encode_ndjson(columns, rows)
+
+
+def export_response(
+    sessions: async_sessionmaker,
+    query: Select,
+    format: ExportFormat,
+    name: str
+) -> StreamingResponse:
+    return StreamingResponse(
+        stream_rows(sessions, query, format),
+        media_type=MEDIA_TYPES[format],
+        headers={
+            'Content-Disposition':
+                f'attachment; filename="{name}.{format.value}"',
+        },
+    )
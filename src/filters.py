@@ -0,0 +1,61 @@
+import datetime
+from typing import List, Optional
+
+from fastapi import Query
+from sqlalchemy import ColumnElement, Select
+
+from .models import Batch
+
+
+class BatchFilters:
+    """Batch query parameters shared by listing, export and statistics."""
+
+    def __init__(
+        self,
+        status: bool = None,
+        line: str = None,
+        shift: str = None,
+        assignment: str = Query(None, min_length=1, max_length=255),
+        date: Optional[datetime.date] = Query(None),
+        date_from: Optional[datetime.date] = Query(None),
+        date_to: Optional[datetime.date] = Query(None),
+        number: int = Query(None, gt=0),
+    ):
+        self.status = status
+        self.line = line
+        self.shift = shift
+        self.assignment = assignment
+        self.date = date
+        self.date_from = date_from
+        self.date_to = date_to
+        self.number = number
+
+    def apply(self, query: Select) -> Select:
+        if self.status is not None:
+            query = query.where(Batch.status == self.status)
+        if self.line is not None:
+            query = query.where(Batch.line == self.line)
+        if self.shift is not None:
+            query = query.where(Batch.shift == self.shift)
+        if self.assignment:
+            query = query.where(
+                Batch.assignment.ilike(f"%{self.assignment}%")
+            )
+        if self.number:
+            query = query.where(Batch.number == self.number)
+        return query.where(*self.date_clauses(Batch.date))
+
+    def date_clauses(self, column) -> List[ColumnElement]:
+        """The date filters applied to ``column``.
+
+        Product queries repeat them on ``Product.date`` so that PostgreSQL
+        only scans the matching partitions.
+        """
+        clauses = []
+        if self.date:
+            clauses.append(column == self.date)
+        if self.date_from:
+            clauses.append(column >= self.date_from)
+        if self.date_to:
+            clauses.append(column <= self.date_to)
+        return clauses
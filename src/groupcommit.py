@@ -0,0 +1,140 @@
+"""Group commit for single-code aggregation (``AGGREGATION_QUEUE_ENABLED``).
+
+Every ``PATCH /products/`` normally commits on its own, one WAL flush per
+scanned code. With the queue enabled the requests of a worker wait in
+:data:`AGGREGATION_QUEUE`, and a flusher applies them together with
+:func:`crud.aggregate_products` in one transaction as soon as
+``AGGREGATION_QUEUE_MAX_SIZE`` codes are waiting or
+``AGGREGATION_QUEUE_MAX_DELAY_MS`` after it started collecting. Each
+request is answered only after its group has committed, so a reported
+aggregation is as durable as before. Results are the same as for
+requests committed one after another in queue order.
+"""
+import asyncio
+import logging
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from . import crud, database
+from .instrumentation import QUERY_STATS
+from .metrics import REGISTRY
+from .schemas import Aggregation, AggregationResult
+from .settings import (AGGREGATION_QUEUE_ENABLED,
+                       AGGREGATION_QUEUE_MAX_DELAY_MS,
+                       AGGREGATION_QUEUE_MAX_SIZE)
+
+logger = logging.getLogger(__name__)
+
+GROUP_SIZE = REGISTRY.histogram(
+    'aggregation_group_size',
+    'Aggregations applied per group commit.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+GROUP_COMMIT_SECONDS = REGISTRY.histogram(
+    'aggregation_group_commit_seconds',
+    'Time to apply and commit one group of aggregations.',
+)
+
+# The aggregation, its states from crud.known_states() and its result.
+Pending = Tuple[
+    Aggregation,
+    Optional[Dict[str, Optional[crud.ProductState]]],
+    asyncio.Future,
+]
+
+
+class AggregationQueue:
+    def __init__(self, enabled: bool, max_size: int, max_delay: float):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending: List[Pending] = []
+        self.full: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def submit(
+        self,
+        sessions: async_sessionmaker,
+        aggregation: Aggregation,
+        known: Optional[Dict[str, Optional[crud.ProductState]]] = None
+    ) -> AggregationResult:
+        """Aggregate ``aggregation`` in the next group, once it committed.
+
+        ``known`` are the states the caller already looked up.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((aggregation, known, future))
+        if self.task is None or self.task.done():
+            # The flusher stops once the queue is empty, a new event loop
+            # therefore never finds one of an old loop running.
+            self.full = asyncio.Event()
+            self.task = asyncio.create_task(self.run(sessions))
+        elif len(self.pending) >= self.max_size:
+            self.full.set()
+        # A disconnecting client must not cancel the group's future.
+        return await asyncio.shield(future)
+
+    async def run(self, sessions: async_sessionmaker) -> None:
+        # The task copied the context of the request that started it, whose
+        # query stats must not collect the statements of every group.
+        QUERY_STATS.set(None)
+        while self.pending:
+            if len(self.pending) < self.max_size:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self.full.clear()
+            group = self.pending[:self.max_size]
+            self.pending = self.pending[self.max_size:]
+            await self.flush(sessions, group)
+
+    async def flush(
+        self,
+        sessions: async_sessionmaker,
+        group: List[Pending]
+    ) -> None:
+        started = perf_counter()
+        known = {}
+        lookups = []
+        for aggregation, states, _ in group:
+            if states is None:
+                lookups.append(aggregation.code)
+            else:
+                known.update(states)
+        try:
+            known.update(await crud.known_states(lookups))
+            async with sessions() as db:
+                await database.checkout(db)
+                results = await crud.aggregate_products(
+                    db, [aggregation for aggregation, _, _ in group],
+                    products=True, known=known,
+                )
+                await db.commit()
+        except Exception as error:
+            logger.exception('group of %d aggregations failed', len(group))
+            for _, _, future in group:
+                future.set_exception(error)
+            return
+        GROUP_COMMIT_SECONDS.observe(perf_counter() - started)
+        GROUP_SIZE.observe(len(group))
+        for (_, _, future), result in zip(group, results):
+            future.set_result(result)
+
+    def depth(self) -> int:
+        return len(self.pending)
+
+
+AGGREGATION_QUEUE = AggregationQueue(
+    AGGREGATION_QUEUE_ENABLED,
+    AGGREGATION_QUEUE_MAX_SIZE,
+    AGGREGATION_QUEUE_MAX_DELAY_MS / 1000,
+)
+
+REGISTRY.gauge(
+    'aggregation_queue_depth',
+    'Aggregations waiting for the next group commit.',
+    AGGREGATION_QUEUE.depth,
+)
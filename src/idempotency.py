@@ -0,0 +1,266 @@
+"""``Idempotency-Key`` support for retried POST and PATCH requests.
+
+The first request with a key claims it, runs normally and, when it
+succeeds, stores its response. A retry with the same key and body gets
+the stored response back without touching batches or products; the same
+key with another body is rejected with 422, and a retry arriving while
+the first request is still running gets 409.
+"""
+import hashlib
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from .cache import MISSING, LRUCache
+from .crud import dialect_insert
+from .database import get_sessionmaker
+from .metrics import REGISTRY
+from .models import IdempotencyKey
+from .settings import (IDEMPOTENCY_LOCK_TTL, IDEMPOTENCY_MAXSIZE,
+                       IDEMPOTENCY_STORE, IDEMPOTENCY_TTL)
+
+HEADER = b'idempotency-key'
+MAX_KEY_LENGTH = 255
+METHODS = {'POST', 'PATCH'}
+
+IDEMPOTENT_REPLAYS = REGISTRY.counter(
+    'idempotent_replays_total', 'Responses replayed for a repeated key.'
+)
+
+
+class StoredResponse(NamedTuple):
+    fingerprint: Optional[str]
+    # None while the first request is still running.
+    status_code: Optional[int]
+    content_type: Optional[str]
+    body: Optional[bytes]
+
+
+class DatabaseStore:
+    """Keys in the ``idempotency_key`` table, shared by every worker."""
+
+    def __init__(self, sessions: async_sessionmaker):
+        self.sessions = sessions
+
+    async def get(self, key: str) -> Optional[StoredResponse]:
+        async with self.sessions() as db:
+            row = (await db.execute(
+                select(
+                    IdempotencyKey.fingerprint,
+                    IdempotencyKey.status_code,
+                    IdempotencyKey.content_type,
+                    IdempotencyKey.body,
+                ).where(
+                    IdempotencyKey.key == key,
+                    IdempotencyKey.expires_at > datetime.now(),
+                )
+            )).first()
+        return None if row is None else StoredResponse(*row)
+
+    async def claim(self, key: str) -> bool:
+        """Take ``key`` for a new request; False if someone holds it."""
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=IDEMPOTENCY_LOCK_TTL)
+        table = IdempotencyKey.__table__
+        async with self.sessions() as db:
+            claimed = await db.scalar(
+                dialect_insert(db, table)
+                .values(key=key, expires_at=expires_at)
+                .on_conflict_do_nothing(index_elements=[table.c.key])
+                .returning(table.c.key)
+            )
+            if claimed is None:
+                # Only an expired key can be taken over.
+                claimed = await db.scalar(
+                    update(table)
+                    .where(table.c.key == key, table.c.expires_at <= now)
+                    .values(
+                        fingerprint=None, status_code=None,
+                        content_type=None, body=None, expires_at=expires_at,
+                    )
+                    .returning(table.c.key)
+                )
+            await db.commit()
+        return claimed is not None
+
+    async def save(self, key: str, response: StoredResponse) -> None:
+        expires_at = datetime.now() + timedelta(seconds=IDEMPOTENCY_TTL)
+        async with self.sessions() as db:
+            await db.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.key == key)
+                .values(**response._asdict(), expires_at=expires_at)
+            )
+            await db.commit()
+
+    async def release(self, key: str) -> None:
+        async with self.sessions() as db:
+            await db.execute(
+                delete(IdempotencyKey).where(IdempotencyKey.key == key)
+            )
+            await db.commit()
+
+    async def evict(self) -> int:
+        async with self.sessions() as db:
+            result = await db.execute(
+                delete(IdempotencyKey)
+                .where(IdempotencyKey.expires_at <= datetime.now())
+            )
+            await db.commit()
+        return result.rowcount
+
+
+class MemoryStore:
+    """Keys in a bounded per-process LRU cache.
+
+    Cheaper than :class:`DatabaseStore`, but a retry only replays when it
+    reaches the same worker process.
+    """
+
+    def __init__(self, maxsize: int):
+        self.cache = LRUCache('idempotency', maxsize, IDEMPOTENCY_TTL)
+
+    async def get(self, key: str) -> Optional[StoredResponse]:
+        response = self.cache.get(key)
+        return None if response is MISSING else response
+
+    async def claim(self, key: str) -> bool:
+        # Nothing awaits between the lookup and the write, so no other
+        # request of this event loop can claim the key in between.
+        if self.cache.get(key) is not MISSING:
+            return False
+        self.cache.set(
+            key, StoredResponse(None, None, None, None), IDEMPOTENCY_LOCK_TTL
+        )
+        return True
+
+    async def save(self, key: str, response: StoredResponse) -> None:
+        self.cache.set(key, response)
+
+    async def release(self, key: str) -> None:
+        self.cache.invalidate(key)
+
+    async def evict(self) -> int:
+        return 0
+
+
+MEMORY_STORE = MemoryStore(IDEMPOTENCY_MAXSIZE)
+
+
+def get_store(scope):
+    if IDEMPOTENCY_STORE == 'memory':
+        return MEMORY_STORE
+    # Middleware runs outside dependency injection, honour overrides here.
+    overrides = scope['app'].dependency_overrides
+    return DatabaseStore(overrides.get(get_sessionmaker, get_sessionmaker)())
+
+
+async def send_response(
+    send,
+    status_code: int,
+    body: bytes,
+    content_type: str = 'application/json',
+    replayed: bool = False
+) -> None:
+    headers = [
+        (b'content-type', content_type.encode()),
+        (b'content-length', str(len(body)).encode()),
+    ]
+    if replayed:
+        headers.append((b'idempotent-replayed', b'true'))
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class IdempotencyMiddleware:
+    """Replay stored responses for repeated ``Idempotency-Key`` requests.
+
+    Keys are scoped by method and path. Only successful (2xx) responses
+    are stored; for anything else the key is released so the client can
+    retry. The request body is fingerprinted while the route reads it, so
+    streamed uploads are not buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] not in METHODS:
+            return await self.app(scope, receive, send)
+        header = dict(scope['headers']).get(HEADER)
+        if header is None:
+            return await self.app(scope, receive, send)
+        if not 0 < len(header) <= MAX_KEY_LENGTH:
+            return await send_response(
+                send, 400,
+                b'{"detail":"Idempotency-Key must be 1-255 characters"}',
+            )
+        key = f"{scope['method']} {scope['path']} {header.decode('latin-1')}"
+        store = get_store(scope)
+
+        stored = await store.get(key)
+        if stored is None and await store.claim(key):
+            return await self.run(store, key, scope, receive, send)
+        if stored is None or stored.status_code is None:
+            return await send_response(
+                send, 409,
+                b'{"detail":"A request with this Idempotency-Key '
+                b'is in progress"}',
+            )
+        digest = hashlib.sha256()
+        while True:
+            message = await receive()
+            digest.update(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        if digest.hexdigest() != stored.fingerprint:
+            return await send_response(
+                send, 422,
+                b'{"detail":"Idempotency-Key was used with another body"}',
+            )
+        IDEMPOTENT_REPLAYS.inc()
+        await send_response(
+            send, stored.status_code, stored.body, stored.content_type,
+            replayed=True,
+        )
+
+    async def run(self, store, key: str, scope, receive, send) -> None:
+        digest = hashlib.sha256()
+        response = {'status': None, 'content_type': None, 'body': []}
+
+        async def fingerprint_receive():
+            message = await receive()
+            if message['type'] == 'http.request':
+                digest.update(message.get('body', b''))
+            return message
+
+        async def recording_send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['content_type'] = dict(
+                    message.get('headers', [])
+                ).get(b'content-type', b'').decode('latin-1')
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, fingerprint_receive, recording_send)
+        except BaseException:
+            await store.release(key)
+            raise
+        if response['status'] is not None and 200 <= response['status'] < 300:
+            await store.save(key, StoredResponse(
+                digest.hexdigest(),
+                response['status'],
+                response['content_type'],
+                b''.join(response['body']),
+            ))
+        else:
+            await store.release(key)
@@ -0,0 +1,134 @@
+"""Streaming NDJSON/CSV product ingest.
+
+The request body is decoded line by line and validated rows are flushed
+through :func:`crud.ingest_products` every ``PRODUCT_INSERT_CHUNK_SIZE``
+rows, each chunk in its own transaction. Memory use is bounded by the
+chunk size rather than by the size of the upload.
+"""
+import codecs
+import csv
+import json
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .crud import ingest_products
+from .schemas import (ExportFormat, IngestError, ProductCreate,
+                      ProductStreamReport)
+from .settings import (INGEST_MAX_ERRORS, INGEST_MAX_LINE_BYTES,
+                       PRODUCT_INSERT_CHUNK_SIZE)
+
+# (line number, parsed record, error message)
+Record = Tuple[int, Optional[dict], Optional[str]]
+
+
+def body_format(content_type: Optional[str]) -> ExportFormat:
+    if content_type and content_type.split(';')[0].strip() == 'text/csv':
+        return ExportFormat.csv
+    return ExportFormat.ndjson
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode a UTF-8 byte stream (with or without a BOM) into lines."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    tail = ''
+    async for chunk in chunks:
+        lines = (tail + decoder.decode(chunk)).split('\n')
+        tail = lines.pop()
+        if len(tail) > INGEST_MAX_LINE_BYTES:
+            raise HTTPException(status_code=413, detail="Line is too long")
+        for line in lines:
+            yield line.rstrip('\r')
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield tail.rstrip('\r')
+
+
+async def parse_ndjson(lines: AsyncIterator[str]) -> AsyncIterator[Record]:
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield number, None, f"Invalid JSON: {exc}"
+            continue
+        if not isinstance(record, dict):
+            yield number, None, "Expected a JSON object"
+            continue
+        yield number, record, None
+
+
+async def parse_csv(lines: AsyncIterator[str]) -> AsyncIterator[Record]:
+    """Rows keyed by the header line; ``;`` is accepted as a delimiter."""
+    number = 0
+    header = None
+    delimiter = ','
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        if header is None:
+            if ';' in line and ',' not in line:
+                delimiter = ';'
+            header = next(csv.reader([line], delimiter=delimiter))
+            continue
+        fields = next(csv.reader([line], delimiter=delimiter))
+        if len(fields) != len(header):
+            yield number, None, (
+                f"Expected {len(header)} fields, got {len(fields)}"
+            )
+            continue
+        yield number, dict(zip(header, fields)), None
+
+
+def validation_detail(exc: ValidationError) -> str:
+    return '; '.join(
+        f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+        for error in exc.errors()
+    )
+
+
+async def ingest_stream(
+    db: AsyncSession,
+    chunks: AsyncIterator[bytes],
+    format: ExportFormat
+) -> ProductStreamReport:
+    """Validate and insert products from a streamed NDJSON or CSV body.
+
+    Every chunk is committed before the next one is read, so rows flushed
+    before a failure or a dropped connection stay in the database.
+    """
+    parse = parse_csv if format == ExportFormat.csv else parse_ndjson
+    report = ProductStreamReport()
+    products: List[ProductCreate] = []
+
+    async def flush():
+        chunk = await ingest_products(db, products)
+        await db.commit()
+        report.chunks += 1
+        report.created += chunk.created
+        report.duplicates += chunk.duplicates
+        report.batch_not_found += chunk.batch_not_found
+        products.clear()
+
+    async for number, record, error in parse(read_lines(chunks)):
+        report.rows += 1
+        if error is None:
+            try:
+                products.append(ProductCreate.model_validate(record))
+            except ValidationError as exc:
+                error = validation_detail(exc)
+        if error is not None:
+            report.invalid += 1
+            if len(report.errors) < INGEST_MAX_ERRORS:
+                report.errors.append(IngestError(line=number, detail=error))
+        if len(products) >= PRODUCT_INSERT_CHUNK_SIZE:
+            await flush()
+    if products:
+        await flush()
+    return report
@@ -0,0 +1,171 @@
+"""Per-request SQL statement counts and timings.
+
+Engine hooks add every statement to the :class:`QueryStats` of the
+current request, which :class:`QueryTimingMiddleware` creates, reports in
+``Server-Timing``/``X-DB-*`` headers and records in per-route
+histograms. Statements slower than ``SLOW_QUERY_MS`` are logged with the
+shape of their parameters, never the values, and so is the slowest
+statement of a request that ran one.
+"""
+import logging
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .metrics import REGISTRY
+from .settings import SLOW_QUERY_MS
+
+logger = logging.getLogger(__name__)
+
+REQUEST_QUERIES = REGISTRY.histogram(
+    'http_request_db_queries',
+    'SQL statements executed per request.',
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+REQUEST_DB_SECONDS = REGISTRY.histogram(
+    'http_request_db_seconds',
+    'Time spent in SQL statements per request.',
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds',
+    'Request handling time.',
+)
+
+
+SLOWEST_DESC_LENGTH = 80
+
+
+def statement_summary(statement: str, length: Optional[int] = None) -> str:
+    """``statement`` on one line, cut to ``length`` characters."""
+    summary = ' '.join(statement.split())
+    if length is not None and len(summary) > length:
+        summary = summary[:length - 3] + '...'
+    return summary
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement: Optional[str] = None
+
+    def record(self, elapsed: float, statement: str) -> None:
+        self.count += 1
+        self.total += elapsed
+        if self.slowest_statement is None or elapsed > self.slowest:
+            self.slowest = elapsed
+            self.slowest_statement = statement
+
+    def server_timing(self) -> str:
+        timing = (
+            f'db;dur={self.total * 1000:.1f};desc="{self.count} queries", '
+            f'db-slowest;dur={self.slowest * 1000:.1f}'
+        )
+        if self.slowest_statement is not None:
+            # A quoted-string in a latin-1 header.
+            desc = statement_summary(
+                self.slowest_statement, SLOWEST_DESC_LENGTH
+            ).replace('\\', '\\\\').replace('"', '\\"')
+            desc = desc.encode('ascii', 'replace').decode()
+            timing += f';desc="{desc}"'
+        return timing
+
+
+QUERY_STATS: ContextVar[Optional[QueryStats]] = ContextVar(
+    'query_stats', default=None
+)
+
+
+def parameter_shape(parameters: Any) -> str:
+    """Describe bound parameters by type, e.g. ``500 x {code: str}``."""
+    if isinstance(parameters, (list, tuple)) and parameters and isinstance(
+        parameters[0], (dict, list, tuple)
+    ):
+        return f'{len(parameters)} x {parameter_shape(parameters[0])}'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(
+            f'{key}: {type(value).__name__}'
+            for key, value in parameters.items()
+        ) + '}'
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(
+            type(value).__name__ for value in parameters
+        ) + ')'
+    return type(parameters).__name__
+
+
+def instrument_queries(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+
+    # The start time lives on the execution context, which a failed
+    # statement takes with it, instead of on the pooled connection.
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def start_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+        if context is not None:
+            context.query_started = perf_counter()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def stop_timer(conn, cursor, statement, parameters, context,
+                   executemany):
+        started = getattr(context, 'query_started', None)
+        if started is None:
+            return
+        elapsed = perf_counter() - started
+        stats = QUERY_STATS.get()
+        if stats is not None:
+            stats.record(elapsed, statement)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning(
+                'slow query %.1f ms: %s; parameters %s',
+                elapsed * 1000, statement_summary(statement),
+                parameter_shape(parameters),
+            )
+
+
+class QueryTimingMiddleware:
+    """Collect :class:`QueryStats` for each HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = QueryStats()
+        token = QUERY_STATS.set(stats)
+        started = perf_counter()
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.extend([
+                    (b'server-timing', stats.server_timing().encode()),
+                    (b'x-db-query-count', str(stats.count).encode()),
+                    (b'x-db-time-ms', f'{stats.total * 1000:.1f}'.encode()),
+                ])
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            QUERY_STATS.reset(token)
+            # Set by the router once a route matched.
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            labels = {'method': scope['method'], 'route': route}
+            REQUEST_QUERIES.observe(stats.count, **labels)
+            REQUEST_DB_SECONDS.observe(stats.total, **labels)
+            REQUEST_SECONDS.observe(perf_counter() - started, **labels)
+            if SLOW_QUERY_MS and stats.slowest * 1000 >= SLOW_QUERY_MS:
+                logger.warning(
+                    'slow request %s %s: %d queries in %.1f ms, '
+                    'slowest %.1f ms: %s',
+                    scope['method'], route, stats.count, stats.total * 1000,
+                    stats.slowest * 1000,
+                    statement_summary(stats.slowest_statement),
+                )
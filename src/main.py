@@ -1,8 +1,98 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import anyio
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
+
+from . import database, partitions, serialization
+from .bloom import CODE_FILTER
+from .idempotency import IdempotencyMiddleware
+from .instrumentation import QueryTimingMiddleware
+from .models import Batch
+from .routes import router_batches, router_products, router_service
+from .settings import (APP_WARMUP, DB_POOL_WARMUP, PARTITIONS_CHECK_INTERVAL,
+                       PARTITIONS_MONTHS_AHEAD)
+
+logger = logging.getLogger(__name__)
+
+
+async def warm_app(app: FastAPI) -> None:
+    """Do the work otherwise left to the first requests of a worker.
+
+    Builds the OpenAPI schema, runs the response serializers, starts the
+    thread pool of sync dependencies and runs one ORM query, whose
+    compilation sets up SQLAlchemy's compiler once per process.
+    """
+    app.openapi()
+    for adapter in (serialization.BATCH_LIST,
+                    serialization.BATCH_SUMMARY_LIST):
+        adapter.dump_json(adapter.validate_python([]))
+    await anyio.to_thread.run_sync(lambda: None)
+    async with database.get_sessionmaker()() as db:
+        await db.execute(select(Batch).limit(0))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Every worker process runs this, so each one creates, warms and
+    # disposes engines of its own.
+    engine = database.get_engine()
+    replica = database.get_replica()
+    if DB_POOL_WARMUP:
+        opened = await database.warm_pool(engine, DB_POOL_WARMUP)
+        logger.info('database pool warmed with %d connections', opened)
+    if DB_POOL_WARMUP and replica is not None:
+        # A replica that is down only sends reads to the primary.
+        try:
+            await database.warm_pool(replica.engine, DB_POOL_WARMUP)
+        except database.CONNECT_ERRORS:
+            logger.warning('read replica unavailable at startup')
+    if APP_WARMUP:
+        await warm_app(app)
+    tasks = [asyncio.create_task(partitions.keep_partitions(
+        engine, PARTITIONS_MONTHS_AHEAD, PARTITIONS_CHECK_INTERVAL
+    ))]
+    if CODE_FILTER.enabled:
+        tasks.append(asyncio.create_task(
+            CODE_FILTER.run(database.get_sessionmaker())
+        ))
+    yield
+    for task in tasks:
+        task.cancel()
+    # Their connections go back to the pools before these are disposed.
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await database.dispose_engines()
+
+
+def create_app() -> FastAPI:
+    """Build the application; nothing connects until its lifespan starts.
+
+    ``uvicorn --factory src.main:create_app`` calls it in every worker.
+    """
+    app = FastAPI(
+        title="Merchandising app",
+        default_response_class=ORJSONResponse,
+        lifespan=lifespan,
+    )
+
+    app.include_router(router_batches)
+    app.include_router(router_products)
+    app.include_router(router_service)
 
-from .routes import router_batches, router_products
+    # Added first so that it runs inside the timing middleware and replays
+    # report their (single) query as well.
+    app.add_middleware(IdempotencyMiddleware)
+    app.add_middleware(QueryTimingMiddleware)
+    return app
 
-app = FastAPI(title="Merchandising app")
 
-app.include_router(router_batches)
-app.include_router(router_products)
+def __getattr__(name: str):
+    # ``src.main:app`` keeps working, without building an app on import.
+    global app
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
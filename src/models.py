@@ -1,5 +1,6 @@
 from sqlalchemy import (TIMESTAMP, Boolean, Column, Date, DateTime, ForeignKey,
-                        Integer, String)
+                        Index, Integer, LargeBinary, String, UniqueConstraint,
+                        text)
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
 from sqlalchemy.orm import relationship
 
@@ -8,6 +9,26 @@ Base: DeclarativeMeta = declarative_base()
 
 class Batch(Base):
     __tablename__ = "batch"
+    __table_args__ = (
+        UniqueConstraint('date', 'number', name='uq_batch_date_number'),
+        Index('ix_batch_date_id', 'date', 'id'),
+        Index('ix_batch_status_date_id', 'status', 'date', 'id'),
+        Index('ix_batch_line_shift_date_id', 'line', 'shift', 'date', 'id'),
+        Index('ix_batch_number_date_id', 'number', 'date', 'id'),
+        # Closed batches in archiving order, see src/archive.py.
+        Index(
+            'ix_batch_closed_at',
+            'closed_at',
+            postgresql_where=text('status'),
+            sqlite_where=text('status'),
+        ),
+        Index(
+            'ix_batch_assignment_trgm',
+            'assignment',
+            postgresql_using='gin',
+            postgresql_ops={'assignment': 'gin_trgm_ops'},
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     status = Column(Boolean, default=False)
@@ -18,22 +39,121 @@ class Batch(Base):
     number = Column(Integer, nullable=False)
     date = Column(Date, nullable=False)
     nomenclature = Column(String, nullable=False)
-    codekn = Column(String, nullable=False, index=True)
+    codekn = Column(String, nullable=False)
     identificator_rc = Column(String, nullable=False)
     start_time = Column(TIMESTAMP, nullable=False)
     end_time = Column(TIMESTAMP, nullable=False)
     closed_at = Column(TIMESTAMP)
-    products = relationship("Product", back_populates="batch")
+    # Maintained in the transactions that insert and aggregate products;
+    # ``python -m src.cli recount`` rebuilds them from the product table.
+    product_count = Column(Integer, nullable=False, default=0,
+                           server_default='0')
+    aggregated_count = Column(Integer, nullable=False, default=0,
+                              server_default='0')
+    last_aggregated_at = Column(DateTime)
+    # Joining on the date as well lets PostgreSQL prune product partitions.
+    products = relationship(
+        "Product",
+        back_populates="batch",
+        primaryjoin="and_(Batch.id == foreign(Product.batch_id), "
+                    "Batch.date == foreign(Product.date))",
+    )
 
 
 class Product(Base):
+    """A product code attached to a batch.
+
+    On PostgreSQL the table is range-partitioned by ``date`` (see the
+    partition migration and ``python -m src.cli partitions``), so its
+    primary key there is (id, date) and ``code`` only has a plain index.
+    Codes are kept globally unique by ``ProductCode``.
+    """
+
     __tablename__ = 'product'
+    __table_args__ = (
+        Index(
+            'ix_product_batch_id_aggregated',
+            'batch_id',
+            postgresql_where=text('is_aggregated'),
+            sqlite_where=text('is_aggregated'),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
-    code = Column(String, nullable=False, unique=True, index=True)
+    code = Column(String, nullable=False, index=True)
     batch_number = Column(Integer, nullable=False)
     date = Column(Date, nullable=False)
     is_aggregated = Column(Boolean, default=False)
     aggregated_at = Column(DateTime)
-    batch_id = Column(Integer, ForeignKey("batch.id"))
-    batch = relationship("Batch", back_populates="products")
+    batch_id = Column(Integer, ForeignKey("batch.id"), index=True)
+    batch = relationship(
+        "Batch",
+        back_populates="products",
+        primaryjoin="and_(Batch.id == foreign(Product.batch_id), "
+                    "Batch.date == foreign(Product.date))",
+    )
+
+
+class ProductCode(Base):
+    """Registry of every product code ever issued, with its partition key."""
+
+    __tablename__ = 'product_code'
+
+    code = Column(String, primary_key=True)
+    date = Column(Date, nullable=False)
+
+
+class BatchArchive(Base):
+    """A batch moved out of ``batch`` by ``python -m src.cli archive``."""
+
+    __tablename__ = 'batch_archive'
+
+    id = Column(Integer, primary_key=True)
+    status = Column(Boolean)
+    assignment = Column(String, nullable=False)
+    line = Column(String, nullable=False)
+    shift = Column(String, nullable=False)
+    squad = Column(String, nullable=False)
+    number = Column(Integer, nullable=False)
+    date = Column(Date, nullable=False)
+    nomenclature = Column(String, nullable=False)
+    codekn = Column(String, nullable=False)
+    identificator_rc = Column(String, nullable=False)
+    start_time = Column(TIMESTAMP, nullable=False)
+    end_time = Column(TIMESTAMP, nullable=False)
+    closed_at = Column(TIMESTAMP)
+    product_count = Column(Integer, nullable=False)
+    aggregated_count = Column(Integer, nullable=False)
+    last_aggregated_at = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False)
+
+
+class ProductArchive(Base):
+    """A product of an archived batch; looked up by code on a miss."""
+
+    __tablename__ = 'product_archive'
+
+    id = Column(Integer, primary_key=True)
+    code = Column(String, nullable=False, unique=True, index=True)
+    batch_number = Column(Integer, nullable=False)
+    date = Column(Date, nullable=False)
+    is_aggregated = Column(Boolean)
+    aggregated_at = Column(DateTime)
+    batch_id = Column(Integer, index=True)
+    archived_at = Column(DateTime, nullable=False)
+
+
+class IdempotencyKey(Base):
+    """Response of a request sent with an ``Idempotency-Key`` header.
+
+    ``status_code`` stays NULL while the first request is still running.
+    """
+
+    __tablename__ = 'idempotency_key'
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String)
+    status_code = Column(Integer)
+    content_type = Column(String)
+    body = Column(LargeBinary)
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,22 @@
+import base64
+import json
+from datetime import date
+from typing import Tuple
+
+from fastapi import HTTPException
+
+from .models import Batch
+
+
+def encode_cursor(batch: Batch) -> str:
+    """Opaque keyset cursor pointing right after ``batch``."""
+    payload = json.dumps([batch.date.isoformat(), batch.id])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[date, int]:
+    try:
+        batch_date, batch_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return date.fromisoformat(batch_date), int(batch_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
@@ -0,0 +1,163 @@
+"""Monthly range partitions of the product table (PostgreSQL only).
+
+Partitions are named ``product_YYYY_MM`` and cover one calendar month of
+``product.date``; rows outside every partition land in ``product_default``,
+where queries cannot prune them. Every worker therefore keeps the next
+``PARTITIONS_MONTHS_AHEAD`` months created, see :func:`keep_partitions`.
+"""
+import asyncio
+import logging
+import re
+from datetime import date
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+PARENT = 'product'
+DEFAULT = 'product_default'
+NAME = re.compile(r'^product_(\d{4})_(\d{2})$')
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'{PARENT}_{month.year:04d}_{month.month:02d}'
+
+
+async def list_partitions(conn: AsyncConnection) -> List[str]:
+    result = await conn.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :parent
+        ORDER BY child.relname
+    """), {'parent': PARENT})
+    return list(result.scalars())
+
+
+async def is_partitioned(conn: AsyncConnection) -> bool:
+    result = await conn.execute(text("""
+        SELECT EXISTS (
+            SELECT 1
+            FROM pg_partitioned_table
+            JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid
+            WHERE pg_class.relname = :parent
+        )
+    """), {'parent': PARENT})
+    return bool(result.scalar())
+
+
+async def create_partitions(
+    conn: AsyncConnection,
+    start: date,
+    months: int
+) -> List[str]:
+    """Create the missing monthly partitions for ``months`` from ``start``.
+
+    Rows of such a month already in ``product_default`` are moved into the
+    new table before it is attached, which locks the default partition
+    until the transaction ends. Concurrent calls, such as the startup of
+    several workers, wait for each other.
+    """
+    await conn.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(:parent))"),
+        {'parent': PARENT},
+    )
+    existing = set(await list_partitions(conn))
+    created = []
+    month = start.replace(day=1)
+    for _ in range(months):
+        name = partition_name(month)
+        if name not in existing:
+            end = add_months(month, 1)
+            bounds = f"FOR VALUES FROM ('{month}') TO ('{end}')"
+            stranded = DEFAULT in existing and (await conn.execute(
+                text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT} "
+                     f"WHERE date >= :start AND date < :end)"),
+                {'start': month, 'end': end},
+            )).scalar()
+            if stranded:
+                await conn.execute(text(
+                    f"CREATE TABLE {name} (LIKE {PARENT} "
+                    f"INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                ))
+                await conn.execute(text(
+                    f"WITH moved AS (DELETE FROM {DEFAULT} "
+                    f"WHERE date >= :start AND date < :end RETURNING *) "
+                    f"INSERT INTO {name} SELECT * FROM moved"
+                ), {'start': month, 'end': end})
+                await conn.execute(text(
+                    f"ALTER TABLE {PARENT} ATTACH PARTITION {name} {bounds}"
+                ))
+            else:
+                await conn.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF {PARENT} {bounds}"
+                ))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+async def keep_partitions(
+    engine: AsyncEngine,
+    months_ahead: int,
+    interval: float
+) -> None:
+    """Create the partitions ``months_ahead`` every ``interval`` seconds.
+
+    Runs until cancelled. Failures are logged and retried on the next
+    round, meanwhile new rows only land in ``product_default``.
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+    while True:
+        try:
+            async with engine.begin() as conn:
+                if not await is_partitioned(conn):
+                    return
+                created = await create_partitions(
+                    conn, date.today(), months_ahead + 1
+                )
+            if created:
+                logger.info('product partitions created: %s',
+                            ', '.join(created))
+        except Exception:
+            logger.exception('creating product partitions failed')
+        await asyncio.sleep(interval)
+
+
+async def detach_partitions(
+    conn: AsyncConnection,
+    before: date,
+    lock_timeout_ms: int
+) -> List[str]:
+    """Detach the monthly partitions that end on or before ``before``.
+
+    The detached tables are kept, so they can be archived or dropped later.
+    ``DETACH ... CONCURRENTLY`` is not allowed while a default partition
+    exists, so every detach takes a short ACCESS EXCLUSIVE lock instead and
+    gives up after ``lock_timeout_ms`` rather than queueing the API behind
+    it.
+    """
+    await conn.execute(
+        text(f"SET LOCAL lock_timeout = {int(lock_timeout_ms)}")
+    )
+    detached = []
+    for name in await list_partitions(conn):
+        match = NAME.match(name)
+        if match is None:
+            continue
+        month = date(int(match.group(1)), int(match.group(2)), 1)
+        if add_months(month, 1) <= before:
+            await conn.execute(
+                text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}")
+            )
+            detached.append(name)
+    return detached
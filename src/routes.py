@@ -1,14 +1,34 @@
-from datetime import date, datetime
+from datetime import datetime
 from typing import List, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import (APIRouter, Depends, HTTPException, Query, Request,
+                     Response, status)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy import select, tuple_
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import selectinload
 
-from .database import get_db
-from .models import Batch, Product
-from .schemas import (Aggregation, BatchCreate, BatchRead, BatchUpdate,
-                      ProductCreate, ProductRead)
+from . import crud, database
+from .cache import BATCH_KEY_CACHE, stage
+from .database import (get_db, get_read_db, get_read_sessionmaker,
+                       get_sessionmaker)
+from .events import event_stream, mark_changed
+from .export import batches_query, export_response, products_query
+from .filters import BatchFilters
+from .groupcommit import AGGREGATION_QUEUE
+from .ingest import body_format, ingest_stream
+from .metrics import REGISTRY
+from .models import Batch
+from .pagination import decode_cursor, encode_cursor
+from .schemas import (Aggregation, AggregationResult, AggregationStats,
+                      AggregationStatus, BatchCreate, BatchImportReport,
+                      BatchInclude, BatchRead, BatchSummaryRead, BatchUpdate,
+                      ExportFormat, HealthRead, IngestStatus, ProductCreate,
+                      ProductIngestReport, ProductRead, ProductStreamReport,
+                      StatsGroup)
+from .serialization import BATCH, BATCH_LIST, BATCH_SUMMARY_LIST, json_response
+from .settings import HEALTH_POOL_SATURATION
 
 router_batches = APIRouter(
     tags=['batches'],
@@ -16,58 +36,117 @@ router_batches = APIRouter(
 )
 
 
-@router_batches.get('/', response_model=List[BatchRead])
-def get_batches(
-    db: Session = Depends(get_db),
-    status: bool = None,
-    line: str = None,
-    shift: str = None,
-    assignment: str = Query(None, min_length=1, max_length=255),
-    date: Optional[Union[date, str]] = Query(None),
-    number: int = Query(None, gt=0),
+@router_batches.get(
+    '/',
+    response_model=Union[List[BatchSummaryRead], List[BatchRead]]
+)
+async def get_batches(
+    db: AsyncSession = Depends(get_read_db),
+    filters: BatchFilters = Depends(),
     limit: int = Query(10, gt=0, le=1000),
+    offset: int = Query(0, ge=0),
+    after: Optional[str] = Query(None, description="X-Next-Cursor value"),
+    include: Optional[BatchInclude] = Query(None)
+):
+    query = filters.apply(select(Batch))
+    if after:
+        query = query.where(
+            tuple_(Batch.date, Batch.id) > decode_cursor(after)
+        )
+    adapter = BATCH_SUMMARY_LIST
+    if include == BatchInclude.products:
+        query = query.options(selectinload(Batch.products))
+        adapter = BATCH_LIST
+    query = query.order_by(Batch.date, Batch.id).offset(offset).limit(limit)
+    batches = (await db.scalars(query)).all()
+    headers = {}
+    if len(batches) == limit:
+        headers['X-Next-Cursor'] = encode_cursor(batches[-1])
+    return json_response(adapter, batches, headers=headers)
+
+
+@router_batches.get('/export/', response_class=StreamingResponse)
+async def export_batches(
+    filters: BatchFilters = Depends(),
+    format: ExportFormat = Query(ExportFormat.ndjson),
+    sessions: async_sessionmaker = Depends(get_read_sessionmaker)
+):
+    return export_response(
+        sessions, batches_query(filters), format, 'batches'
+    )
+
+
+@router_batches.get(
+    '/stats/',
+    response_model=List[AggregationStats],
+    response_model_exclude_none=True
+)
+async def get_batch_stats(
+    db: AsyncSession = Depends(get_read_db),
+    filters: BatchFilters = Depends(),
+    group_by: StatsGroup = Query(StatsGroup.batch),
+    limit: int = Query(100, gt=0, le=1000),
     offset: int = Query(0, ge=0)
 ):
-    query = db.query(Batch)
-    if status is not None:
-        query = query.filter(Batch.status == status)
-    if line is not None:
-        query = query.filter(Batch.line == line)
-    if shift is not None:
-        query = query.filter(Batch.shift == shift)
-    if assignment:
-        query = query.filter(Batch.assignment.ilike(f"%{assignment}%"))
-    if date:
-        query = query.filter(Batch.date == date)
-    if number:
-        query = query.filter(Batch.number == number)
-    query = query.offset(offset).limit(limit)
-    return query.all()
+    return await crud.aggregation_stats(db, filters, group_by, limit, offset)
+
+
+@router_batches.get(
+    '/events/',
+    response_class=StreamingResponse,
+    responses={200: {'content': {'text/event-stream': {}}}},
+)
+async def batch_events(
+    batch_id: List[int] = Query([]),
+    line: List[str] = Query([]),
+    sessions: async_sessionmaker = Depends(get_sessionmaker)
+):
+    """Push BatchProgress of the subscribed batches and lines as SSE.
+
+    Clients get the current state of every ``batch_id`` first, then one
+    ``batch`` event per changed batch at most every EVENTS_INTERVAL.
+    """
+    if not batch_id and not line:
+        raise HTTPException(
+            status_code=422, detail="Subscribe to a batch_id or a line"
+        )
+    return StreamingResponse(
+        event_stream(sessions, batch_id, line),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 
 @router_batches.get('/{id}/', response_model=BatchRead)
-def get_batch(id: int, db: Session = Depends(get_db)):
-    batch = db.query(Batch).get(id)
+async def get_batch(id: int, db: AsyncSession = Depends(get_read_db)):
+    batch = await db.get(Batch, id, options=[selectinload(Batch.products)])
     if batch is None:
         raise HTTPException(status_code=404, detail="Batch doesn't exists")
-    return batch
+    return json_response(BATCH, batch)
 
 
-@router_batches.post('/', status_code=status.HTTP_201_CREATED)
-def create_batch(batches: List[BatchCreate], db: Session = Depends(get_db)):
-    for batch in batches:
-        date = batch.date
-        number = batch.number
-        existing_batches = db.query(Batch).filter(
-            Batch.date == date,
-            Batch.number == number
-        ).all()
-        for existing_batch in existing_batches:
-            db.delete(existing_batch)
-        new_batch = Batch(**batch.dict())
-        db.add(new_batch)
-    db.commit()
-    return batches
+@router_batches.post(
+    '/',
+    status_code=status.HTTP_201_CREATED,
+    response_model=BatchImportReport
+)
+async def create_batch(
+    batches: List[BatchCreate],
+    db: AsyncSession = Depends(get_db)
+):
+    report = await crud.upsert_batches(db, batches)
+    await db.commit()
+    return report
+
+
+def violates_batch_key(error: IntegrityError) -> bool:
+    # asyncpg reports the constraint, SQLite only its columns.
+    cause = error.orig.__cause__
+    if getattr(cause, 'sqlstate', None) == '23505':
+        return cause.constraint_name == 'uq_batch_date_number'
+    return 'UNIQUE constraint failed: batch.date, batch.number' in str(
+        error.orig
+    )
 
 
 @router_batches.patch(
@@ -75,11 +154,17 @@ def create_batch(batches: List[BatchCreate], db: Session = Depends(get_db)):
     status_code=status.HTTP_200_OK,
     response_model=BatchRead
 )
-def update_batch(id: int, request: BatchUpdate, db: Session = Depends(get_db)):
-    batch = db.query(Batch).get(id)
+async def update_batch(
+    id: int,
+    request: BatchUpdate,
+    db: AsyncSession = Depends(get_db)
+):
+    batch = await db.get(Batch, id)
     if batch is None:
         raise HTTPException(status_code=404, detail="Batch doesn't exists")
-    update_data = request.dict(exclude_unset=True)
+    update_data = request.model_dump(exclude_unset=True)
+    old_date, old_number = batch.date, batch.number
+    stage(db, BATCH_KEY_CACHE, (batch.date, batch.number))
     if 'status' in update_data and update_data['status'] != batch.status:
         if update_data['status']:
             batch.closed_at = datetime.now()
@@ -87,8 +172,23 @@ def update_batch(id: int, request: BatchUpdate, db: Session = Depends(get_db)):
             batch.closed_at = None
     for field, value in update_data.items():
         setattr(batch, field, value)
-    db.commit()
-    db.refresh(batch)
+    stage(db, BATCH_KEY_CACHE, (batch.date, batch.number))
+    mark_changed(db, [batch.id])
+    try:
+        await db.flush()
+        if (batch.date, batch.number) != (old_date, old_number):
+            await crud.move_batch_products(db, batch, old_date)
+        await db.commit()
+    except IntegrityError as error:
+        await db.rollback()
+        if not violates_batch_key(error):
+            raise
+        raise HTTPException(
+            status_code=409,
+            detail="Batch with this date and number already exists"
+        )
+    # Loaded only now, see crud.move_batch_products().
+    await db.refresh(batch, ['products'])
     return batch
 
 
@@ -103,53 +203,146 @@ router_products = APIRouter(
     status_code=status.HTTP_201_CREATED,
     response_model=List[ProductRead]
 )
-def create_product(
+async def create_product(
     products: List[ProductCreate],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    added_products = []
-    try:
-        for product in products:
-            batch = db.query(Batch).filter(
-                Batch.date == product.date,
-                Batch.number == product.batch_number
-            ).first()
-            if batch:
-                new_product = Product(
-                    **product.dict(exclude={'batch'}),
-                    batch_id=batch.id
-                )
-                added_products.append(new_product)
-                db.add(new_product)
-        db.commit()
-        return added_products
-    except IntegrityError:
-        db.rollback()
-        raise HTTPException(
-            status_code=400,
-            detail="Request body is incorrect. Please check the product code"
+    report = await crud.ingest_products(db, products)
+    await db.commit()
+    return [
+        ProductRead(
+            **product.model_dump(),
+            id=item.id,
+            batch_id=item.batch_id,
+            is_aggregated=False,
+            aggregated_at=None,
         )
+        for product, item in zip(products, report.items)
+        if item.status == IngestStatus.created
+    ]
+
+
+@router_products.post(
+    '/bulk/',
+    status_code=status.HTTP_201_CREATED,
+    response_model=ProductIngestReport
+)
+async def create_products_bulk(
+    products: List[ProductCreate],
+    db: AsyncSession = Depends(get_db)
+):
+    report = await crud.ingest_products(db, products)
+    await db.commit()
+    return report
+
+
+@router_products.post(
+    '/stream/',
+    status_code=status.HTTP_201_CREATED,
+    response_model=ProductStreamReport,
+    openapi_extra={'requestBody': {
+        'required': True,
+        'content': {'application/x-ndjson': {}, 'text/csv': {}},
+    }},
+)
+async def create_products_stream(
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    return await ingest_stream(
+        db, request.stream(), body_format(request.headers.get('content-type'))
+    )
+
+
+@router_products.get('/export/', response_class=StreamingResponse)
+async def export_products(
+    filters: BatchFilters = Depends(),
+    format: ExportFormat = Query(ExportFormat.ndjson),
+    sessions: async_sessionmaker = Depends(get_read_sessionmaker)
+):
+    return export_response(
+        sessions, products_query(filters), format, 'products'
+    )
 
 
 @router_products.patch("/", status_code=200, response_model=ProductRead)
-def aggregate_product(aggregation: Aggregation, db: Session = Depends(get_db)):
-    product = db.query(Product).filter(
-        Product.code == aggregation.code
-    ).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found.")
-    if product.is_aggregated:
-        aggregated_at = product.aggregated_at.strftime("%Y-%m-%d %H:%M:%S")
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unique code already used at {aggregated_at}"
+async def aggregate_product(
+    aggregation: Aggregation,
+    sessions: async_sessionmaker = Depends(get_sessionmaker)
+):
+    # Codes the product cache or the code filter reject take no connection,
+    # and queued requests hold none while they wait for their group.
+    known = await crud.known_states([aggregation.code])
+    result = crud.known_rejection(aggregation, known)
+    if result is None and AGGREGATION_QUEUE.enabled:
+        result = await AGGREGATION_QUEUE.submit(
+            sessions, aggregation, known
         )
-    if product.batch_id != aggregation.id:
-        raise HTTPException(
+    elif result is None:
+        async with sessions() as db:
+            await database.checkout(db)
+            result = await crud.aggregate_product(db, aggregation, known)
+            if result.status == AggregationStatus.aggregated:
+                await db.commit()
+    if result.status != AggregationStatus.aggregated:
+        raise aggregation_error(result)
+    return result.product
+
+
+@router_products.patch(
+    '/bulk/',
+    status_code=status.HTTP_200_OK,
+    response_model=List[AggregationResult],
+    response_model_exclude_none=True
+)
+async def aggregate_products_bulk(
+    aggregations: List[Aggregation],
+    sessions: async_sessionmaker = Depends(get_sessionmaker)
+):
+    known = await crud.known_states(
+        aggregation.code for aggregation in aggregations
+    )
+    async with sessions() as db:
+        # A buffer the known states answer entirely takes no connection.
+        if any(
+            crud.known_rejection(aggregation, known) is None
+            for aggregation in aggregations
+        ):
+            await database.checkout(db)
+        results = await crud.aggregate_products(
+            db, aggregations, known=known
+        )
+        await db.commit()
+    return results
+
+
+def aggregation_error(result: AggregationResult) -> HTTPException:
+    if result.status == AggregationStatus.not_found:
+        return HTTPException(status_code=404, detail="Product not found.")
+    if result.status == AggregationStatus.already_aggregated:
+        aggregated_at = result.aggregated_at.strftime("%Y-%m-%d %H:%M:%S")
+        return HTTPException(
             status_code=400,
-            detail="Unique code is attached to another batch"
+            detail=f"Unique code already used at {aggregated_at}"
         )
-    product.is_aggregated = True
-    product.aggregated_at = datetime.now()
-    db.commit()
-    return product
+    return HTTPException(
+        status_code=400,
+        detail="Unique code is attached to another batch"
+    )
+
+
+router_service = APIRouter(tags=['service'])
+
+
+@router_service.get('/health', response_model=HealthRead)
+async def health(response: Response):
+    pool = database.pool_status(database.get_engine())
+    if pool['saturation'] >= HEALTH_POOL_SATURATION:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return HealthRead(status='saturated', pool=pool)
+    return HealthRead(status='ok', pool=pool)
+
+
+@router_service.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return REGISTRY.render()
@@ -1,7 +1,8 @@
 import datetime
+from enum import Enum
 from typing import List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 
 class ProductCreate(BaseModel):
@@ -11,6 +12,8 @@ class ProductCreate(BaseModel):
 
 
 class ProductRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     code: str
     batch_number: int
@@ -20,6 +23,41 @@ class ProductRead(BaseModel):
     batch_id: int
 
 
+class IngestStatus(str, Enum):
+    created = "created"
+    duplicate = "duplicate"
+    batch_not_found = "batch_not_found"
+
+
+class ProductIngestItem(BaseModel):
+    code: str
+    status: IngestStatus
+    id: Optional[int] = None
+    batch_id: Optional[int] = None
+
+
+class ProductIngestReport(BaseModel):
+    created: int = 0
+    duplicates: int = 0
+    batch_not_found: int = 0
+    items: List[ProductIngestItem] = []
+
+
+class IngestError(BaseModel):
+    line: int
+    detail: str
+
+
+class ProductStreamReport(BaseModel):
+    rows: int = 0
+    chunks: int = 0
+    created: int = 0
+    duplicates: int = 0
+    batch_not_found: int = 0
+    invalid: int = 0
+    errors: List[IngestError] = []
+
+
 class BatchCreate(BaseModel):
     status: bool = Field(..., alias="СтатусЗакрытия")
     assignment: str = Field(..., alias="ПредставлениеЗаданияНаСмену")
@@ -35,7 +73,24 @@ class BatchCreate(BaseModel):
     end_time: datetime.datetime = Field(..., alias="ДатаВремяОкончанияСмены")
 
 
-class BatchRead(BaseModel):
+class BatchImportReport(BaseModel):
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+
+class BatchInclude(str, Enum):
+    products = "products"
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class BatchSummaryRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     status: bool
     assignment: str
@@ -50,9 +105,31 @@ class BatchRead(BaseModel):
     start_time: datetime.datetime
     end_time: datetime.datetime
     closed_at: Optional[datetime.datetime]
+    product_count: int
+    aggregated_count: int
+    last_aggregated_at: Optional[datetime.datetime]
+
+
+class BatchRead(BatchSummaryRead):
     products: List[ProductRead]
 
 
+class BatchProgress(BaseModel):
+    """Batch state pushed to dashboards by ``GET /batches/events/``."""
+
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    number: int
+    date: datetime.date
+    line: str
+    status: bool
+    closed_at: Optional[datetime.datetime]
+    product_count: int
+    aggregated_count: int
+    last_aggregated_at: Optional[datetime.datetime]
+
+
 class BatchUpdate(BaseModel):
     status: Optional[bool] = None
     assignment: Optional[str] = None
@@ -67,7 +144,59 @@ class BatchUpdate(BaseModel):
     start_time: Optional[datetime.datetime] = None
     end_time: Optional[datetime.datetime] = None
 
+    # Fields are optional to leave them unchanged, never to clear them.
+    @field_validator('*')
+    @classmethod
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError('may not be null')
+        return value
+
 
 class Aggregation(BaseModel):
     id: int
     code: str
+
+
+class AggregationStatus(str, Enum):
+    aggregated = "aggregated"
+    already_aggregated = "already_aggregated"
+    wrong_batch = "wrong_batch"
+    not_found = "not_found"
+
+
+class AggregationResult(BaseModel):
+    code: str
+    status: AggregationStatus
+    aggregated_at: Optional[datetime.datetime] = None
+    product: Optional[ProductRead] = None
+
+
+class StatsGroup(str, Enum):
+    batch = "batch"
+    line = "line"
+    shift = "shift"
+    date = "date"
+
+
+class AggregationStats(BaseModel):
+    batch_id: Optional[int] = None
+    number: Optional[int] = None
+    date: Optional[datetime.date] = None
+    line: Optional[str] = None
+    shift: Optional[str] = None
+    total: int
+    aggregated: int
+    remaining: int
+
+
+class PoolHealth(BaseModel):
+    size: int
+    checked_out: int
+    overflow: int
+    saturation: float
+
+
+class HealthRead(BaseModel):
+    status: str
+    pool: PoolHealth
@@ -0,0 +1,28 @@
+"""Precompiled response serializers for the heavy read endpoints.
+
+FastAPI validates a returned value against ``response_model``, turns it
+into JSON-compatible Python objects and only then encodes it. The
+adapters below validate ORM objects straight into the response models
+(``from_attributes``) and encode them to JSON in pydantic-core in one go.
+"""
+from typing import Any, List
+
+from fastapi import Response
+from pydantic import TypeAdapter
+
+from .schemas import BatchRead, BatchSummaryRead
+
+BATCH = TypeAdapter(BatchRead)
+BATCH_LIST = TypeAdapter(List[BatchRead])
+BATCH_SUMMARY_LIST = TypeAdapter(List[BatchSummaryRead])
+
+
+def json_response(
+    adapter: TypeAdapter,
+    value: Any,
+    **kwargs
+) -> Response:
+    model = adapter.validate_python(value, from_attributes=True)
+    return Response(
+        adapter.dump_json(model), media_type='application/json', **kwargs
+    )
@@ -0,0 +1,36 @@
+"""Production entry point, run as ``python -m src.server``.
+
+Starts ``WEB_WORKERS`` uvicorn worker processes without the reloader.
+uvloop and httptools are used when installed. Workers are spawned, not
+forked, and build the app with :func:`src.main.create_app` themselves;
+each creates its own engine and pool in its lifespan instead of sharing
+the parent's connections. On SIGTERM a worker stops accepting
+connections and waits up to ``WEB_GRACEFUL_TIMEOUT`` seconds for
+in-flight requests before its lifespan disposes the pool.
+"""
+import uvicorn
+
+from .settings import (WEB_ACCESS_LOG, WEB_BACKLOG, WEB_GRACEFUL_TIMEOUT,
+                       WEB_HOST, WEB_KEEPALIVE, WEB_PORT, WEB_WORKERS)
+
+
+def main() -> None:
+    uvicorn.run(
+        'src.main:create_app',
+        factory=True,
+        host=WEB_HOST,
+        port=WEB_PORT,
+        workers=WEB_WORKERS,
+        loop='auto',
+        http='auto',
+        lifespan='on',
+        backlog=WEB_BACKLOG,
+        timeout_keep_alive=WEB_KEEPALIVE,
+        timeout_graceful_shutdown=WEB_GRACEFUL_TIMEOUT,
+        access_log=WEB_ACCESS_LOG,
+        proxy_headers=True,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,153 @@
 import os
+from pathlib import Path
 
 from dotenv import load_dotenv
 
-load_dotenv()
+# An explicit path skips python-dotenv's search through the parent
+# directories of the calling module.
+load_dotenv(os.environ.get(
+    "ENV_FILE", Path(__file__).resolve().parent.parent / ".env"
+))
 
 DB_HOST = os.environ.get("DB_HOST")
 DB_PORT = os.environ.get("DB_PORT")
 DB_NAME = os.environ.get("DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PASS = os.environ.get("DB_PASS")
+
+# Any async SQLAlchemy URL: postgresql+asyncpg:// in production,
+# sqlite+aiosqlite:// for local runs and tests.
+DATABASE_URL = os.environ.get(
+    "DATABASE_URL",
+    f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/postgres"
+)
+
+# Connection pool tuning, ignored for SQLite.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+# Optional read replica for read-only endpoints, same URL format as
+# DATABASE_URL. Reads go to the primary while the replica is unreachable
+# or more than REPLICA_MAX_LAG seconds behind; the state is rechecked every
+# REPLICA_CHECK_INTERVAL seconds.
+REPLICA_DATABASE_URL = os.environ.get("REPLICA_DATABASE_URL", "")
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.environ.get("REPLICA_CHECK_INTERVAL", 5))
+REPLICA_CHECK_TIMEOUT = float(os.environ.get("REPLICA_CHECK_TIMEOUT", 1))
+# Connections opened by each worker at startup, at most DB_POOL_SIZE.
+DB_POOL_WARMUP = int(os.environ.get("DB_POOL_WARMUP", 2))
+# Build the OpenAPI schema and run the response serializers once at
+# startup, so the first requests of a new worker do not pay for it.
+APP_WARMUP = os.environ.get("APP_WARMUP", "true").lower() == "true"
+# /health answers 503 once this share of the pool is checked out.
+HEALTH_POOL_SATURATION = float(
+    os.environ.get("HEALTH_POOL_SATURATION", 0.9)
+)
+
+PRODUCT_INSERT_CHUNK_SIZE = int(
+    os.environ.get("PRODUCT_INSERT_CHUNK_SIZE", 5000)
+)
+BATCH_UPSERT_CHUNK_SIZE = int(
+    os.environ.get("BATCH_UPSERT_CHUNK_SIZE", 1000)
+)
+AGGREGATION_CHUNK_SIZE = int(
+    os.environ.get("AGGREGATION_CHUNK_SIZE", 1000)
+)
+
+# In-process lookup caches for the scan path (see src/cache.py).
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "false").lower() == "true"
+CACHE_MAXSIZE = int(os.environ.get("CACHE_MAXSIZE", 100_000))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 300))
+# Unknown codes are remembered briefly, another worker may insert them.
+CACHE_NEGATIVE_TTL = float(os.environ.get("CACHE_NEGATIVE_TTL", 2))
+
+# python -m src.cli archive: batches closed more than ARCHIVE_AFTER_DAYS
+# days ago move to the archive tables, ARCHIVE_CHUNK_SIZE batches (with
+# their products) per transaction.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 90))
+ARCHIVE_CHUNK_SIZE = int(os.environ.get("ARCHIVE_CHUNK_SIZE", 100))
+
+# Monthly product partitions (PostgreSQL): every worker creates the
+# partitions of the next PARTITIONS_MONTHS_AHEAD months at startup and
+# every PARTITIONS_CHECK_INTERVAL seconds, so that new products never land
+# in product_default, where queries cannot prune them.
+PARTITIONS_MONTHS_AHEAD = int(os.environ.get("PARTITIONS_MONTHS_AHEAD", 3))
+PARTITIONS_CHECK_INTERVAL = float(
+    os.environ.get("PARTITIONS_CHECK_INTERVAL", 86400)
+)
+
+# Bloom filter of issued product codes (see src/bloom.py): unknown codes
+# are answered without querying the product tables. Sized for
+# CODE_FILTER_CAPACITY codes at CODE_FILTER_ERROR_RATE false positives,
+# about 1.8 MB per million codes at 0.001; rebuilds grow it to twice the
+# codes present.
+CODE_FILTER_ENABLED = (
+    os.environ.get("CODE_FILTER_ENABLED", "false").lower() == "true"
+)
+CODE_FILTER_CAPACITY = int(os.environ.get("CODE_FILTER_CAPACITY", 1_000_000))
+CODE_FILTER_ERROR_RATE = float(
+    os.environ.get("CODE_FILTER_ERROR_RATE", 0.001)
+)
+CODE_FILTER_REBUILD_INTERVAL = float(
+    os.environ.get("CODE_FILTER_REBUILD_INTERVAL", 3600)
+)
+
+# Rows fetched per round trip by the streaming export endpoints.
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 5000))
+
+# Group commit for PATCH /products/ (see src/groupcommit.py): scans are
+# committed together, up to AGGREGATION_QUEUE_MAX_SIZE at a time and at
+# most AGGREGATION_QUEUE_MAX_DELAY_MS after the first one arrived.
+AGGREGATION_QUEUE_ENABLED = (
+    os.environ.get("AGGREGATION_QUEUE_ENABLED", "false").lower() == "true"
+)
+AGGREGATION_QUEUE_MAX_SIZE = int(
+    os.environ.get("AGGREGATION_QUEUE_MAX_SIZE", 200)
+)
+AGGREGATION_QUEUE_MAX_DELAY_MS = float(
+    os.environ.get("AGGREGATION_QUEUE_MAX_DELAY_MS", 5)
+)
+
+# Streaming ingest: invalid rows reported in full, and the longest line
+# accepted before the upload is rejected.
+INGEST_MAX_ERRORS = int(os.environ.get("INGEST_MAX_ERRORS", 100))
+INGEST_MAX_LINE_BYTES = int(os.environ.get("INGEST_MAX_LINE_BYTES", 65536))
+
+# Batch progress feed (GET /batches/events/): changes are collected for
+# EVENTS_INTERVAL seconds and pushed as one snapshot per batch. With
+# EVENTS_BROKER=postgres writers also pg_notify the changed batch ids, so
+# every worker process sees them; "local" only sees its own process. The
+# notification is one more statement in every write transaction that
+# changes a batch, scans included, whether or not a dashboard listens;
+# benchmarks/aggregation.py measures it as single_update_notify.
+EVENTS_INTERVAL = float(os.environ.get("EVENTS_INTERVAL", 0.25))
+EVENTS_KEEPALIVE = float(os.environ.get("EVENTS_KEEPALIVE", 15))
+EVENTS_BROKER = os.environ.get("EVENTS_BROKER", "local")
+
+# Log SQL statements slower than this many milliseconds; 0 disables it.
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 0))
+
+# Idempotency-Key replays: "database" shares keys between workers,
+# "memory" keeps them per process. Completed responses are replayed for
+# IDEMPOTENCY_TTL seconds; a request still running holds its key for
+# IDEMPOTENCY_LOCK_TTL seconds, so a crashed worker does not block it.
+IDEMPOTENCY_STORE = os.environ.get("IDEMPOTENCY_STORE", "database")
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 86400))
+IDEMPOTENCY_LOCK_TTL = float(os.environ.get("IDEMPOTENCY_LOCK_TTL", 60))
+IDEMPOTENCY_MAXSIZE = int(os.environ.get("IDEMPOTENCY_MAXSIZE", 10_000))
+
+# Production server (python -m src.server). Every worker has a pool of its
+# own, so the database sees up to
+# WEB_WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+WEB_HOST = os.environ.get("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.environ.get("WEB_PORT", 8000))
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", os.cpu_count() or 1))
+WEB_BACKLOG = int(os.environ.get("WEB_BACKLOG", 2048))
+WEB_KEEPALIVE = int(os.environ.get("WEB_KEEPALIVE", 5))
+# Seconds a stopping worker waits for in-flight requests, such as running
+# aggregations, before closing their connections.
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+WEB_ACCESS_LOG = os.environ.get("WEB_ACCESS_LOG", "false").lower() == "true"
@@ -0,0 +1,12 @@
+def assert_query_budget(response, budget: int) -> None:
+    """Fail when the request behind ``response`` ran over ``budget`` queries.
+
+    The count comes from the X-DB-Query-Count header set by
+    ``QueryTimingMiddleware``, so any endpoint can be checked.
+    """
+    count = int(response.headers['x-db-query-count'])
+    request = response.request
+    assert count <= budget, (
+        f'{request.method} {request.url.path} ran {count} queries, '
+        f'budget is {budget}'
+    )
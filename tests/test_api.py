@@ -1,35 +1,58 @@
+import asyncio
+import json
+import re
+from datetime import date, datetime
+from time import monotonic
+
+import httpx
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-from sqlalchemy import StaticPool, create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import (AsyncAdaptedQueuePool, StaticPool, event, insert, text,
+                        update)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
+                                    create_async_engine)
 
-from src.database import get_db
+from src import (archive, bloom, crud, database, events, groupcommit, ingest,
+                 main, partitions, routes)
+from src.cache import BATCH_KEY_CACHE, CACHE_HITS, MISSING, PRODUCT_CACHE
+from src.database import get_db, get_sessionmaker
+from src.idempotency import DatabaseStore, MemoryStore, StoredResponse
+from src.instrumentation import (QUERY_STATS, QueryStats, instrument_queries,
+                                 parameter_shape)
 from src.main import app
-from src.models import Base
+from src.models import Base, Batch
+from src.schemas import Aggregation
+from tests.helpers import assert_query_budget
 
 client = TestClient(app)
 
-DATABASE_TEST_URL = "sqlite:///:memory:"
-engine = create_engine(
+DATABASE_TEST_URL = "sqlite+aiosqlite:///:memory:"
+engine = create_async_engine(
     DATABASE_TEST_URL,
     connect_args={
         "check_same_thread": False,
     },
     poolclass=StaticPool,
 )
-TestingSessionLocal = sessionmaker(
-    autocommit=False,
+instrument_queries(engine)
+# Pool checkouts, pre-pings are not in the query counts.
+checkouts = []
+event.listen(engine.sync_engine, "checkout", lambda *args: checkouts.append(1))
+TestingSessionLocal = async_sessionmaker(
     autoflush=False,
+    expire_on_commit=False,
     bind=engine
 )
 
 
-def override_get_db():
-    database = TestingSessionLocal()
-    yield database
-    database.close()
+async def override_get_db():
+    async with TestingSessionLocal() as database:
+        yield database
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_sessionmaker] = lambda: TestingSessionLocal
 
 
 def test_create_batch():
@@ -66,10 +89,7 @@ def test_create_batch():
         ]
     )
     assert response.status_code == 201
-    data = response.json()
-    assert data[0]['НомерПартии'] == 11111
-    assert data[0]['СтатусЗакрытия'] is False
-    assert len(data) == 2
+    assert response.json() == {"inserted": 2, "updated": 0, "unchanged": 0}
 
 
 def test_list_batch():
@@ -86,6 +106,26 @@ def test_list_limit_offset_search():
     data = response.json()
     assert len(data) == 1
     assert data[0]['date'] == "2024-02-11"
+    response = client.get("/batches/?date=2024-02-11")
+    assert [batch['number'] for batch in response.json()] == [22222]
+    response = client.get("/batches/?date=yesterday")
+    assert response.status_code == 422
+
+
+def test_list_cursor_pagination():
+    response = client.get("/batches/?limit=1")
+    assert response.status_code == 200
+    assert response.json()[0]['date'] == "2024-02-10"
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/batches/?limit=1&after={cursor}")
+    assert response.status_code == 200
+    assert response.json()[0]['date'] == "2024-02-11"
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/batches/?limit=1&after={cursor}")
+    assert response.json() == []
+    assert "X-Next-Cursor" not in response.headers
+    response = client.get("/batches/?after=garbage")
+    assert response.status_code == 400
 
 
 def test_retrieve_batch():
@@ -102,6 +142,14 @@ def test_update_batch():
     assert response.status_code == 200
     assert response.json()["identificator_rc"] == "This field is updated"
     assert response.json()["closed_at"] is not None
+    response = client.patch("/batches/1", json={
+        "date": "2024-02-11", "number": 22222
+    })
+    assert response.status_code == 409
+    assert client.get("/batches/1/").json()["number"] == 11111
+    for field in ("date", "number", "status"):
+        response = client.patch("/batches/1", json={field: None})
+        assert response.status_code == 422
 
 
 def test_create_product():
@@ -137,6 +185,82 @@ def test_create_product():
     # another has unexist batch_number
 
 
+def test_create_products_bulk():
+    response = client.post(
+        "/products/bulk/", json=[
+            {
+                "УникальныйКодПродукта": "Fastapi",
+                "НомерПартии": 11111,
+                "ДатаПартии": "2024-02-10"
+            },
+            {
+                "УникальныйКодПродукта": "Pydantic",
+                "НомерПартии": 11111,
+                "ДатаПартии": "2024-02-10"
+            },
+            {
+                "УникальныйКодПродукта": "Pydantic",
+                "НомерПартии": 22222,
+                "ДатаПартии": "2024-02-11"
+            },
+            {
+                "УникальныйКодПродукта": "Uvicorn",
+                "НомерПартии": 86093,
+                "ДатаПартии": "2024-02-10"
+            }
+        ]
+    )
+    assert response.status_code == 201
+    data = response.json()
+    assert data["created"] == 1
+    assert data["duplicates"] == 2
+    assert data["batch_not_found"] == 1
+    assert [item["status"] for item in data["items"]] == [
+        "duplicate", "created", "duplicate", "batch_not_found"
+    ]
+    assert data["items"][1]["batch_id"] == 1
+
+
+def test_reimport_batches():
+    response = client.post(
+        "/batches/", json=[
+            {
+                "СтатусЗакрытия": True,
+                "ПредставлениеЗаданияНаСмену": "Задание на тестовую смену",
+                "Линия": "Тестовая",
+                "Смена": "1",
+                "Бригада": "Бригада тестировщиков",
+                "НомерПартии": 11111,
+                "ДатаПартии": "2024-02-10",
+                "Номенклатура": "QA is my life",
+                "КодЕКН": "11111",
+                "ИдентификаторРЦ": "This field is updated",
+                "ДатаВремяНачалаСмены": "2024-01-30T20:00:00+05:00",
+                "ДатаВремяОкончанияСмены": "2024-01-31T08:00:00+05:00"
+            },
+            {
+                "СтатусЗакрытия": False,
+                "ПредставлениеЗаданияНаСмену": "Задание на тестовую смену2",
+                "Линия": "Тестовая2",
+                "Смена": "2",
+                "Бригада": "Бригада тестировщиков2",
+                "НомерПартии": 22222,
+                "ДатаПартии": "2024-02-11",
+                "Номенклатура": "Updated nomenclature",
+                "КодЕКН": "22222",
+                "ИдентификаторРЦ": "QA2",
+                "ДатаВремяНачалаСмены": "2024-01-31T20:00:00+05:00",
+                "ДатаВремяОкончанияСмены": "2024-02-01T08:00:00+05:00"
+            },
+        ]
+    )
+    assert response.status_code == 201
+    assert response.json() == {"inserted": 0, "updated": 1, "unchanged": 1}
+    response = client.get("/batches/2/")
+    assert response.json()["nomenclature"] == "Updated nomenclature"
+    assert response.json()["products"][0]["code"] == "Postgres"
+
+
 def test_product_attach_to_batch():
     response = client.get("/batches/1/")
     assert response.status_code == 200
@@ -171,9 +295,799 @@ def test_aggregation():
     assert response.json()["detail"][:27] == 'Unique code already used at'
 
 
-def setup() -> None:
-    Base.metadata.create_all(bind=engine)
+def test_list_batch_summary_and_include():
+    response = client.get("/batches/?number=11111")
+    assert response.status_code == 200
+    data = response.json()
+    assert "products" not in data[0]
+    assert data[0]["product_count"] == 2
+    assert data[0]["aggregated_count"] == 1
+    assert data[0]["last_aggregated_at"] is not None
+    response = client.get("/batches/?number=11111&include=products")
+    assert response.status_code == 200
+    data = response.json()
+    assert data[0]["product_count"] == 2
+    assert [product["code"] for product in data[0]["products"]] == [
+        "Fastapi", "Pydantic"
+    ]
+
+
+def test_export_batches():
+    response = client.get("/batches/export/?date_from=2024-02-11")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["number"] for row in rows] == [22222]
+    assert rows[0]["date"] == "2024-02-11"
+    response = client.get("/batches/export/?format=csv&date_to=2024-02-11")
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0].startswith("id,status,assignment")
+    assert len(lines) == 3
+
+
+def test_export_products():
+    response = client.get("/products/export/?number=11111")
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["code"] for row in rows] == ["Fastapi", "Pydantic"]
+    assert rows[0]["is_aggregated"] is True
+
+
+def test_bulk_aggregation():
+    response = client.patch("/products/bulk/", json=[
+        {"id": 1, "code": "Pydantic"},
+        {"id": 1, "code": "Pydantic"},
+        {"id": 1, "code": "Fastapi"},
+        {"id": 1, "code": "Postgres"},
+        {"id": 1, "code": "Unexist product"},
+    ])
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["status"] for item in data] == [
+        "aggregated", "already_aggregated", "already_aggregated",
+        "wrong_batch", "not_found"
+    ]
+    assert data[1]["aggregated_at"] == data[0]["aggregated_at"]
+    assert "aggregated_at" not in data[4]
+
+
+def test_batch_stats():
+    response = client.get("/batches/stats/")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"batch_id": 1, "number": 11111, "date": "2024-02-10",
+         "line": "Тестовая", "shift": "1",
+         "total": 2, "aggregated": 2, "remaining": 0},
+        {"batch_id": 2, "number": 22222, "date": "2024-02-11",
+         "line": "Тестовая2", "shift": "2",
+         "total": 1, "aggregated": 0, "remaining": 1},
+    ]
+    response = client.get("/batches/stats/?group_by=date&date_from=2024-02-11")
+    assert response.json() == [
+        {"date": "2024-02-11", "total": 1, "aggregated": 0, "remaining": 1}
+    ]
+    response = client.get("/batches/stats/?group_by=shift&line=Тестовая")
+    assert response.json() == [
+        {"shift": "1", "total": 2, "aggregated": 2, "remaining": 0}
+    ]
+
+
+def test_recount_batches():
+    async def corrupt_and_recount():
+        async with TestingSessionLocal() as database:
+            await database.execute(update(Batch).values(product_count=0))
+            repaired = await crud.recount_batches(database, [1, 2])
+            await database.commit()
+            return repaired
+
+    assert asyncio.run(corrupt_and_recount()) == 2
+    response = client.get("/batches/1/")
+    assert response.json()["product_count"] == 2
+    assert response.json()["aggregated_count"] == 2
+
+
+def test_product_cache():
+    PRODUCT_CACHE.maxsize = 100
+    try:
+        scan = {"id": 1, "code": "Postgres"}
+        response = client.patch("/products/", json=scan)
+        assert response.status_code == 400
+        hits = CACHE_HITS.value(cache="product")
+        checked_out = len(checkouts)
+        response = client.patch("/products/", json=scan)
+        assert response.json()["detail"] == \
+            'Unique code is attached to another batch'
+        assert CACHE_HITS.value(cache="product") == hits + 1
+        response = client.patch("/products/bulk/", json=[scan])
+        assert response.json()[0]["status"] == "wrong_batch"
+        assert CACHE_HITS.value(cache="product") == hits + 2
+        # Cached rejections take no connection.
+        assert len(checkouts) == checked_out
+    finally:
+        PRODUCT_CACHE.maxsize = 0
+        PRODUCT_CACHE.clear()
+
+
+def test_stale_batch_key_cache():
+    async def foreign_keys(enabled):
+        async with engine.connect() as connection:
+            await connection.exec_driver_sql(
+                f"PRAGMA foreign_keys = {'ON' if enabled else 'OFF'}"
+            )
+
+    moved = (date(2024, 2, 10), 11111)
+    deleted = (date(2024, 2, 10), 99999)
+    BATCH_KEY_CACHE.maxsize = 100
+    asyncio.run(foreign_keys(True))
+    try:
+        # Entries another worker did not see invalidated.
+        BATCH_KEY_CACHE.set(moved, 999)
+        BATCH_KEY_CACHE.set(deleted, 998)
+        response = client.post("/products/bulk/", json=[
+            {
+                "УникальныйКодПродукта": "StaleKey1",
+                "НомерПартии": 11111,
+                "ДатаПартии": "2024-02-10"
+            },
+            {
+                "УникальныйКодПродукта": "StaleKey2",
+                "НомерПартии": 99999,
+                "ДатаПартии": "2024-02-10"
+            },
+        ])
+        assert response.status_code == 201
+        assert [item["status"] for item in response.json()["items"]] == [
+            "created", "batch_not_found"
+        ]
+        assert response.json()["items"][0]["batch_id"] == 1
+        assert BATCH_KEY_CACHE.get(moved) == 1
+        assert BATCH_KEY_CACHE.get(deleted) is MISSING
+    finally:
+        asyncio.run(foreign_keys(False))
+        BATCH_KEY_CACHE.maxsize = 0
+        BATCH_KEY_CACHE.clear()
+
+
+def test_create_products_stream(monkeypatch):
+    monkeypatch.setattr(ingest, "PRODUCT_INSERT_CHUNK_SIZE", 2)
+    rows = [
+        {"УникальныйКодПродукта": "Alembic", "НомерПартии": 22222,
+         "ДатаПартии": "2024-02-11"},
+        {"УникальныйКодПродукта": "Postgres", "НомерПартии": 22222,
+         "ДатаПартии": "2024-02-11"},
+        {"УникальныйКодПродукта": "Asyncpg", "НомерПартии": 86093,
+         "ДатаПартии": "2024-02-11"},
+        {"УникальныйКодПродукта": "Broken", "НомерПартии": "x"},
+    ]
+    body = "\n".join(json.dumps(row) for row in rows) + "\n{not json\n"
+    response = client.post(
+        "/products/stream/",
+        content=body.encode(),
+        headers={"content-type": "application/x-ndjson"},
+    )
+    assert response.status_code == 201
+    data = response.json()
+    assert data["rows"] == 5
+    assert data["chunks"] == 2
+    assert (data["created"], data["duplicates"], data["batch_not_found"]) \
+        == (1, 1, 1)
+    assert data["invalid"] == 2
+    assert [error["line"] for error in data["errors"]] == [4, 5]
+    assert data["errors"][0]["detail"].startswith("НомерПартии")
+    body = "\ufeffУникальныйКодПродукта;НомерПартии;ДатаПартии\r\n" \
+        "Uvloop;22222;2024-02-11\r\nShort;22222\r\n"
+    response = client.post(
+        "/products/stream/",
+        content=body.encode(),
+        headers={"content-type": "text/csv"},
+    )
+    data = response.json()
+    assert (data["rows"], data["created"], data["invalid"]) == (2, 1, 1)
+    assert data["errors"][0] == {
+        "line": 3, "detail": "Expected 3 fields, got 2"
+    }
+
+
+def test_query_budgets():
+    budgets = {
+        "/batches/": 1,
+        "/batches/?include=products": 2,
+        "/batches/1/": 2,
+        "/batches/stats/": 1,
+    }
+    for url, budget in budgets.items():
+        assert_query_budget(client.get(url), budget)
+    response = client.patch("/products/", json={"id": 2, "code": "Alembic"})
+    assert response.status_code == 200
+    assert_query_budget(response, 2)
+    response = client.post("/products/", json=[
+        {
+            "УникальныйКодПродукта": f"Budget{number}",
+            "НомерПартии": 22222,
+            "ДатаПартии": "2024-02-11"
+        }
+        for number in range(50)
+    ])
+    assert len(response.json()) == 50
+    assert_query_budget(response, 4)
+    response = client.post("/products/bulk/", json=[{
+        "УникальныйКодПродукта": "Budget0",
+        "НомерПартии": 11111,
+        "ДатаПартии": "2024-02-10"
+    }])
+    assert response.json()["duplicates"] == 1
+    assert response.headers["server-timing"].startswith("db;dur=")
+    assert re.search(
+        r'db-slowest;dur=[\d.]+;desc="[A-Z]+ ',
+        response.headers["server-timing"],
+    )
+    stats = QueryStats()
+    stats.record(0.002, 'SELECT "product".code\n  FROM product')
+    stats.record(0.001, 'SELECT 1')
+    assert stats.server_timing().endswith(
+        'db-slowest;dur=2.0;desc="SELECT \\"product\\".code FROM product"'
+    )
+    assert parameter_shape([{"code": "x", "id": 1}] * 3) == \
+        "3 x {code: str, id: int}"
+
+    async def fail_then_count():
+        stats = QueryStats()
+        token = QUERY_STATS.set(stats)
+        try:
+            async with engine.connect() as connection:
+                try:
+                    await connection.execute(text("SELECT * FROM missing"))
+                except OperationalError:
+                    pass
+                await connection.execute(text("SELECT 1"))
+                return stats, dict(connection.info)
+        finally:
+            QUERY_STATS.reset(token)
+
+    # A failed statement leaves nothing behind on the pooled connection.
+    stats, info = asyncio.run(fail_then_count())
+    assert stats.count == 1 and stats.slowest_statement == "SELECT 1"
+    assert "query_started" not in info
+
+
+def test_idempotency_key():
+    batch = {
+        "СтатусЗакрытия": False,
+        "ПредставлениеЗаданияНаСмену": "Повтор",
+        "Линия": "Тестовая",
+        "Смена": "1",
+        "Бригада": "Бригада тестировщиков",
+        "НомерПартии": 33333,
+        "ДатаПартии": "2024-02-12",
+        "Номенклатура": "Retry",
+        "КодЕКН": "33333",
+        "ИдентификаторРЦ": "QA3",
+        "ДатаВремяНачалаСмены": "2024-02-01T20:00:00+05:00",
+        "ДатаВремяОкончанияСмены": "2024-02-02T08:00:00+05:00"
+    }
+    headers = {"Idempotency-Key": "retry-1"}
+    first = client.post("/batches/", json=[batch], headers=headers)
+    assert first.json() == {"inserted": 1, "updated": 0, "unchanged": 0}
+    replay = client.post("/batches/", json=[batch], headers=headers)
+    assert (replay.status_code, replay.content) == (201, first.content)
+    assert replay.headers["idempotent-replayed"] == "true"
+    assert_query_budget(replay, 1)
+    response = client.post(
+        "/batches/", json=[{**batch, "Линия": "Другая"}], headers=headers
+    )
+    assert response.status_code == 422
+    # Failed requests release their key.
+    headers = {"Idempotency-Key": "retry-2"}
+    assert client.post("/batches/", json=[{}], headers=headers) \
+        .status_code == 422
+    response = client.post("/batches/", json=[batch], headers=headers)
+    assert response.json()["unchanged"] == 1
+    store = DatabaseStore(TestingSessionLocal)
+    assert asyncio.run(store.claim("POST /batches/ retry-3"))
+    response = client.post(
+        "/batches/", json=[batch], headers={"Idempotency-Key": "retry-3"}
+    )
+    assert response.status_code == 409
+
+    store = MemoryStore(10)
+    assert asyncio.run(store.claim("key"))
+    assert not asyncio.run(store.claim("key"))
+    response = StoredResponse("hash", 201, "application/json", b"{}")
+    asyncio.run(store.save("key", response))
+    assert asyncio.run(store.get("key")) == response
+
+
+def test_read_replica(monkeypatch):
+    replica_engine = create_async_engine(
+        DATABASE_TEST_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+
+    async def seed_replica():
+        async with replica_engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.execute(Batch.__table__.insert().values(
+                assignment="Реплика", line="1", shift="1", squad="1",
+                number=77777, date=date(2024, 2, 13), nomenclature="1",
+                codekn="1", identificator_rc="1",
+                start_time=datetime(2024, 2, 13, 8),
+                end_time=datetime(2024, 2, 13, 20),
+            ))
+
+    asyncio.run(seed_replica())
+    replica = database.Replica(replica_engine, 5, 0)
+    monkeypatch.setattr(database, "replica", replica)
+    response = client.get("/batches/?number=77777")
+    assert [batch["assignment"] for batch in response.json()] == ["Реплика"]
+    assert client.get("/batches/?number=11111").json() == []
+    # Writes always go to the primary.
+    response = client.patch("/batches/1/", json={"squad": "Бригада"})
+    assert response.status_code == 200
+
+    async def lagging(connection):
+        return 60.0
+
+    monkeypatch.setattr(database, "replication_lag", lagging)
+    response = client.get("/batches/?number=11111")
+    assert [batch["id"] for batch in response.json()] == [1]
+    assert replica.lag == 60.0
+
+    # A replica that stops accepting connections between two checks.
+    replica = database.Replica(
+        create_async_engine("sqlite+aiosqlite:////nonexistent/replica.db"),
+        5, 3600,
+    )
+    replica.usable, replica.checked_at = True, monotonic()
+    monkeypatch.setattr(database, "replica", replica)
+    assert client.get("/batches/1/").json()["squad"] == "Бригада"
+    assert not replica.usable
+
+    # A replica session is closed when its pool is exhausted, too.
+    closed = []
+
+    class ReplicaSession(AsyncSession):
+        async def close(self):
+            closed.append(self)
+            await super().close()
+
+    async def exhausted(db):
+        raise HTTPException(status_code=503)
+
+    replica = database.Replica(replica_engine, 5, 3600)
+    replica.sessions = async_sessionmaker(replica_engine, class_=ReplicaSession)
+    replica.usable, replica.checked_at = True, monotonic()
+    monkeypatch.setattr(database, "replica", replica)
+    monkeypatch.setattr(database, "checkout", exhausted)
+    assert client.get("/batches/1/").status_code == 503
+    assert len(closed) == 1
+    asyncio.run(replica_engine.dispose())
+
+
+def test_batch_events(monkeypatch):
+    assert client.get("/batches/events/").status_code == 422
+    feed = events.Feed(3600, "local")
+    monkeypatch.setattr(events, "FEED", feed)
+
+    async def scenario():
+        stream = events.event_stream(TestingSessionLocal, [2], [])
+        assert await stream.__anext__() == "retry: 1000\n\n"
+        initial = json.loads((await stream.__anext__()).split("data: ")[1])
+        for code in ("Budget1", "Budget2"):
+            async with TestingSessionLocal() as db:
+                await crud.aggregate_product(
+                    db, Aggregation(id=2, code=code)
+                )
+                await db.commit()
+        assert feed.dirty == {2}
+        await feed.flush()
+        chunk = await stream.__anext__()
+        assert chunk.startswith("event: batch\n")
+        progress = json.loads(chunk.split("data: ")[1])
+        assert progress["aggregated_count"] == initial["aggregated_count"] + 2
+        lines = events.event_stream(
+            TestingSessionLocal, [], ["Тестовая"], keepalive=0.01
+        )
+        await lines.__anext__()
+        assert await lines.__anext__() == ": keepalive\n\n"
+        await lines.aclose()
+        await stream.aclose()
+        assert not feed.subscriptions
+
+        async def unavailable(condition):
+            raise ConnectionError("database unavailable")
+
+        feed.snapshot = unavailable
+        stream = events.event_stream(TestingSessionLocal, [2], [])
+        try:
+            await stream.__anext__()
+        except ConnectionError as error:
+            assert str(error) == "database unavailable"
+        else:
+            raise AssertionError("the snapshot did not fail")
+        # A failed initial snapshot leaves no subscription behind.
+        assert not feed.subscriptions
+        feed.task.cancel()
+
+    asyncio.run(scenario())
+
+    # Large commits are announced in several NOTIFY payloads.
+    batch_ids = range(1, 100001)
+    chunks = list(events.payloads(batch_ids))
+    assert len(chunks) > 1
+    assert all(len(chunk.encode()) < 8000 for chunk in chunks)
+    assert [
+        int(batch_id) for chunk in chunks for batch_id in chunk.split(",")
+    ] == list(batch_ids)
+
+
+def test_archive_batches():
+    async def seed():
+        async with TestingSessionLocal() as db:
+            batch_id = await db.scalar(insert(Batch).values(
+                assignment="Архив", line="1", shift="1", squad="1",
+                number=33333, date=date(2023, 5, 1), nomenclature="1",
+                codekn="1", identificator_rc="1",
+                start_time=datetime(2023, 5, 1, 8),
+                end_time=datetime(2023, 5, 1, 20),
+                status=True, closed_at=datetime(2023, 5, 2),
+            ).returning(Batch.id))
+            await db.commit()
+        return batch_id
+
+    async def run_archive():
+        async with TestingSessionLocal() as db:
+            moved = await archive.archive_batches(
+                db, datetime(2024, 1, 1), 10
+            )
+            await db.commit()
+        return moved
+
+    batch_id = asyncio.run(seed())
+    response = client.post("/products/", json=[
+        {
+            "УникальныйКодПродукта": code,
+            "НомерПартии": 33333,
+            "ДатаПартии": "2023-05-01"
+        }
+        for code in ("Archived1", "Archived2")
+    ])
+    assert len(response.json()) == 2
+    response = client.patch(
+        "/products/", json={"id": batch_id, "code": "Archived1"}
+    )
+    assert response.status_code == 200
+
+    assert asyncio.run(run_archive()) == (1, 2)
+    assert asyncio.run(run_archive()) == (0, 0)
+    assert client.get(f"/batches/{batch_id}/").status_code == 404
+    # Archived codes are still explained, through the archive ...
+    response = client.patch("/products/", json={"id": 1, "code": "Archived1"})
+    assert response.json()["detail"][:27] == 'Unique code already used at'
+    response = client.patch("/products/bulk/", json=[
+        {"id": 1, "code": "Archived2"},
+        {"id": 1, "code": "Archived1"},
+        {"id": 1, "code": "Unexist product"},
+    ])
+    assert [item["status"] for item in response.json()] == [
+        "wrong_batch", "already_aggregated", "not_found"
+    ]
+    # ... and cannot be issued again.
+    response = client.post("/products/bulk/", json=[{
+        "УникальныйКодПродукта": "Archived2",
+        "НомерПартии": 11111,
+        "ДатаПартии": "2024-02-10"
+    }])
+    assert response.json()["duplicates"] == 1
+
+
+def test_code_filter(monkeypatch):
+    bloom_filter = bloom.BloomFilter(1000, 0.01)
+    for index in range(1000):
+        bloom_filter.add(f"code-{index}")
+    assert all(f"code-{index}" in bloom_filter for index in range(1000))
+    false_positives = sum(
+        f"other-{index}" in bloom_filter for index in range(10000)
+    )
+    assert false_positives < 200
+    assert 0.005 < bloom_filter.false_positive_rate < 0.02
+
+    code_filter = bloom.CodeFilter(1000, 0.01, True, 3600)
+    monkeypatch.setattr(crud, "CODE_FILTER", code_filter)
+    # Every code goes to the database until the filter is built.
+    response = client.patch("/products/", json={"id": 1, "code": "Garbage"})
+    assert response.status_code == 404
+    assert int(response.headers["x-db-query-count"]) > 0
+    asyncio.run(code_filter.build(TestingSessionLocal))
+    checked_out = len(checkouts)
+    response = client.patch("/products/", json={"id": 1, "code": "Garbage"})
+    assert response.status_code == 404
+    assert_query_budget(response, 0)
+    assert len(checkouts) == checked_out
+    response = client.patch("/products/bulk/", json=[
+        {"id": 1, "code": "Garbage"},
+        {"id": 1, "code": "Fastapi"},
+    ])
+    assert [item["status"] for item in response.json()] == [
+        "not_found", "already_aggregated"
+    ]
+    # Codes inserted through the API are known at once.
+    response = client.post("/products/", json=[{
+        "УникальныйКодПродукта": "Filtered",
+        "НомерПартии": 11111,
+        "ДатаПартии": "2024-02-10"
+    }])
+    assert response.status_code == 201
+    response = client.patch("/products/", json={"id": 1, "code": "Filtered"})
+    assert response.status_code == 200
+    assert "code_filter_rejections_total 2" in client.get("/metrics").text
+
+    class Notifications:
+        """The LISTEN connection, delivering another worker's codes."""
+
+        async def fetchval(self, query):
+            code_filter.learn(delivered)
+
+    delivered = []
+    monkeypatch.setattr(
+        crud, "CODE_FILTER", bloom.CodeFilter(1000, 0.01, True, 3600)
+    )
+    response = client.post("/products/", json=[{
+        "УникальныйКодПродукта": "Notified",
+        "НомерПартии": 11111,
+        "ДатаПартии": "2024-02-10"
+    }])
+    assert response.status_code == 201
+    monkeypatch.setattr(crud, "CODE_FILTER", code_filter)
+    code_filter.connection = Notifications()
+    delivered.append("Notified")
+    syncs = bloom.CODE_FILTER_SYNCS.value()
+    # The notification is still on its way, the sync waits for it.
+    response = client.patch("/products/", json={"id": 1, "code": "Notified"})
+    assert response.status_code == 200
+    response = client.patch("/products/bulk/", json=[
+        {"id": 1, "code": "Garbage"},
+        {"id": 1, "code": "Other garbage"},
+    ])
+    assert [item["status"] for item in response.json()] == [
+        "not_found", "not_found"
+    ]
+    assert_query_budget(response, 0)
+    assert bloom.CODE_FILTER_SYNCS.value() == syncs + 2
+
+    async def overlapping_misses():
+        first = asyncio.ensure_future(code_filter.missing(["Garbage"]))
+        await asyncio.sleep(0)
+        return await asyncio.wait_for(asyncio.gather(
+            first,
+            code_filter.missing(["Other garbage"]),
+            code_filter.missing(["Fastapi", "Third garbage"]),
+        ), 1)
+
+    # Misses after a round trip was sent share the next one.
+    assert asyncio.run(overlapping_misses()) == [
+        {"Garbage"}, {"Other garbage"}, {"Third garbage"}
+    ]
+    assert code_filter.syncer is None
+    assert bloom.CODE_FILTER_SYNCS.value() == syncs + 4
+
+    # A rebuild keeps the codes of transactions still open when it scans.
+    async def rebuild_during_insert():
+        async with TestingSessionLocal() as db:
+            await db.execute(text("SELECT 1"))
+            bloom.learn_codes(db, code_filter, ["Uncommitted"])
+            await code_filter.build(TestingSessionLocal)
+            assert bloom.UNCOMMITTED
+        assert not bloom.UNCOMMITTED
+
+    asyncio.run(rebuild_during_insert())
+    assert "Uncommitted" in code_filter.filter
+
+
+def test_aggregation_queue(monkeypatch, tmp_path):
+    response = client.post("/products/", json=[
+        {
+            "УникальныйКодПродукта": code,
+            "НомерПартии": 11111,
+            "ДатаПартии": "2024-02-10"
+        }
+        for code in ("Queued1", "Queued2", "Queued3", "Queued4", "Queued5")
+    ])
+    assert len(response.json()) == 5
+    queue = groupcommit.AggregationQueue(True, 3, 0.05)
+    groups = groupcommit.GROUP_SIZE.count()
+
+    async def scan():
+        return await asyncio.gather(*(
+            queue.submit(TestingSessionLocal, Aggregation(id=1, code=code))
+            for code in ("Queued1", "Queued2", "Queued1", "Unexist product")
+        ))
+
+    results = asyncio.run(scan())
+    assert [result.status for result in results] == [
+        "aggregated", "aggregated", "already_aggregated", "not_found"
+    ]
+    assert results[0].product.code == "Queued1"
+    assert results[2].aggregated_at == results[0].aggregated_at
+    # Three codes filled the first group, the fourth waited for the next.
+    assert groupcommit.GROUP_SIZE.count() == groups + 2
+    assert queue.task.done() and not queue.pending
+
+    monkeypatch.setattr(routes, "AGGREGATION_QUEUE", queue)
+    response = client.patch("/products/", json={"id": 1, "code": "Queued3"})
+    assert response.status_code == 200
+    assert response.json()["is_aggregated"] is True
+    response = client.patch("/products/", json={"id": 1, "code": "Queued3"})
+    assert response.json()["detail"][:27] == 'Unique code already used at'
+
+    async def scan_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as async_client:
+            return await asyncio.gather(*(
+                async_client.patch(
+                    "/products/", json={"id": 1, "code": code}
+                )
+                for code in ("Queued4", "Queued5", "Unexist product")
+            ))
+
+    # Group statements are not charged to the request that started it.
+    responses = asyncio.run(scan_concurrently())
+    assert [response.status_code for response in responses] == [
+        200, 200, 404
+    ]
+    assert [
+        response.headers["x-db-query-count"] for response in responses
+    ] == ["0", "0", "0"]
+
+    async def scan_without_connections():
+        busy = create_async_engine(
+            f"sqlite+aiosqlite:///{tmp_path / 'busy.db'}",
+            poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0,
+            pool_timeout=0.01,
+        )
+        try:
+            async with busy.connect():
+                await queue.submit(
+                    async_sessionmaker(busy), Aggregation(id=1, code="Busy")
+                )
+        except HTTPException as error:
+            return error.status_code
+        finally:
+            await busy.dispose()
+
+    # A group that gets no connection answers like the unqueued path.
+    assert asyncio.run(scan_without_connections()) == 503
+
+
+def test_bulk_aggregation_repeated_code():
+    response = client.post("/products/", json=[{
+        "УникальныйКодПродукта": "Rescanned",
+        "НомерПартии": 11111,
+        "ДатаПартии": "2024-02-10"
+    }])
+    assert response.status_code == 201
+    # A wrong scan of a code does not hide a later correct one.
+    response = client.patch("/products/bulk/", json=[
+        {"id": 2, "code": "Rescanned"},
+        {"id": 1, "code": "Rescanned"},
+        {"id": 1, "code": "Rescanned"},
+        {"id": 2, "code": "Rescanned"},
+    ])
+    assert [item["status"] for item in response.json()] == [
+        "wrong_batch", "aggregated", "already_aggregated",
+        "already_aggregated"
+    ]
+
+
+def test_move_batch_date():
+    async def seed():
+        async with TestingSessionLocal() as db:
+            batch_id = await db.scalar(insert(Batch).values(
+                assignment="Перенос", line="1", shift="1", squad="1",
+                number=44444, date=date(2024, 3, 1), nomenclature="1",
+                codekn="1", identificator_rc="1",
+                start_time=datetime(2024, 3, 1, 8),
+                end_time=datetime(2024, 3, 1, 20),
+            ).returning(Batch.id))
+            await db.commit()
+        return batch_id
+
+    async def recount(batch_id):
+        async with TestingSessionLocal() as db:
+            return await crud.recount_batches(db, [batch_id])
+
+    batch_id = asyncio.run(seed())
+    response = client.post("/products/", json=[
+        {
+            "УникальныйКодПродукта": code,
+            "НомерПартии": 44444,
+            "ДатаПартии": "2024-03-01"
+        }
+        for code in ("Moved1", "Moved2")
+    ])
+    assert len(response.json()) == 2
+    response = client.patch(f"/batches/{batch_id}/", json={
+        "date": "2024-04-02", "number": 44445
+    })
+    assert response.status_code == 200
+    assert [
+        (product["date"], product["batch_number"])
+        for product in response.json()["products"]
+    ] == [("2024-04-02", 44445)] * 2
+    response = client.patch(
+        "/products/", json={"id": batch_id, "code": "Moved1"}
+    )
+    assert response.status_code == 200
+    response = client.patch(
+        "/products/bulk/", json=[{"id": batch_id, "code": "Moved2"}]
+    )
+    assert response.json()[0]["status"] == "aggregated"
+    response = client.get(f"/batches/{batch_id}/")
+    assert len(response.json()["products"]) == 2
+    assert response.json()["aggregated_count"] == 2
+    assert asyncio.run(recount(batch_id)) == 0
+
+
+def test_health_and_metrics():
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ok"
+    assert response.json()["pool"]["checked_out"] == 0
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "# TYPE db_pool_checked_out gauge" in response.text
+    assert "db_pool_timeouts_total" in response.text
+    assert 'http_request_db_queries_count{method="GET",' \
+        'route="/batches/{id}/"}' in response.text
+
+
+def test_create_app(monkeypatch, tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'app.db'}"
+
+    async def create_tables():
+        app_engine = create_async_engine(url)
+        async with app_engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        await app_engine.dispose()
+
+    asyncio.run(create_tables())
+    asyncio.run(database.dispose_engines())
+    monkeypatch.setattr(database, "DATABASE_URL", url)
+    finished = []
+
+    async def keep_partitions(*args):
+        try:
+            await asyncio.sleep(3600)
+        finally:
+            await asyncio.sleep(0)
+            # Background tasks end before the engines are disposed.
+            finished.append("engine" in vars(database))
+
+    monkeypatch.setattr(partitions, "keep_partitions", keep_partitions)
+    factory_app = main.create_app()
+    # Nothing connects before the lifespan starts.
+    assert "engine" not in vars(database)
+    with TestClient(factory_app) as factory_client:
+        assert database.engine.url.database.endswith("app.db")
+        assert factory_app.openapi_schema is not None
+        assert factory_client.get("/batches/").json() == []
+    assert "engine" not in vars(database)
+    assert finished == [True]
+
+
+async def run_metadata(method, dispose: bool = False) -> None:
+    async with engine.begin() as connection:
+        await connection.run_sync(method)
+    if dispose:
+        await engine.dispose()
+
+
+def setup_module() -> None:
+    asyncio.run(run_metadata(Base.metadata.create_all))
 
 
-def teardown() -> None:
-    Base.metadata.drop_all(bind=engine)
+def teardown_module() -> None:
+    asyncio.run(run_metadata(Base.metadata.drop_all, dispose=True))